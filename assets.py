@@ -0,0 +1,107 @@
+"""Images, sounds and fonts, loaded the first time they're asked for"""
+from __future__ import division
+import sys
+import timeit
+from concurrent.futures import ThreadPoolExecutor,Future
+import pygame
+
+class AssetManager:
+    """Loads each asset once, on first use, and keeps it. Images are
+    converted to the display's pixel format so blits don't convert them
+    every time. That needs the display, so call displayReady right after
+    set_mode; without it (headless) images stay as loaded. Sounds can be
+    decoded ahead of time on a background thread with loadInBackground,
+    asking for one that isn't done yet waits for it. With verbose, the
+    time each load took is written to stream as it happens."""
+    def __init__(self,verbose=False,stream=sys.stdout):
+        self.verbose = verbose
+        self.stream = stream
+        self.images = {}
+        self.sounds = {} #name -> Sound, or a Future while it's being decoded
+        self.fonts = {}
+        self.musicName = None #Loaded in the music stream
+        self.displayFormat = False
+        self.executor = None
+        self.timings = [] #(name,seconds) in the order they were loaded
+
+    def timed(self,name,load,*args):
+        start = timeit.default_timer()
+        asset = load(*args)
+        seconds = timeit.default_timer()-start
+        self.timings.append((name,seconds))
+        if self.verbose:
+            self.stream.write("%8.2f ms  %s\n" % (seconds*1000,name))
+        return asset
+
+    def displayReady(self):
+        """Convert images from now on, and the ones already loaded"""
+        self.displayFormat = True
+        for name,image in self.images.items():
+            self.images[name] = self.convert(image)
+
+    def convert(self,image):
+        if image.get_flags() & pygame.SRCALPHA:
+            return image.convert_alpha()
+        return image.convert()
+
+    def loadImage(self,name):
+        image = pygame.image.load(name)
+        if self.displayFormat:
+            image = self.convert(image)
+        return image
+
+    def image(self,name):
+        image = self.images.get(name)
+        if image is None:
+            image = self.images[name] = self.timed(name,self.loadImage,name)
+        return image
+
+    def sound(self,name):
+        sound = self.sounds.get(name)
+        if sound is None:
+            sound = self.sounds[name] = self.timed(name,pygame.mixer.Sound,name)
+        elif isinstance(sound,Future):
+            sound = self.sounds[name] = sound.result()
+        return sound
+
+    def loadInBackground(self,names):
+        """Start decoding sounds on a worker thread, in the order given"""
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(1)
+        for name in names:
+            if name not in self.sounds:
+                self.sounds[name] = self.executor.submit(self.timed,name+" (background)",
+                                                         pygame.mixer.Sound,name)
+
+    def font(self,name,size):
+        key = (name,size,False)
+        font = self.fonts.get(key)
+        if font is None:
+            font = self.fonts[key] = self.timed(name,pygame.font.Font,name,size)
+        return font
+
+    def sysFont(self,name,size):
+        """A system font, see pygame.font.SysFont"""
+        key = (name,size,True)
+        font = self.fonts.get(key)
+        if font is None:
+            font = self.fonts[key] = self.timed("system font "+name,
+                                                pygame.font.SysFont,name,size)
+        return font
+
+    def music(self,name):
+        """Load name as the music stream (it's streamed, not decoded),
+        unless it already is"""
+        if name != self.musicName:
+            self.timed(name,pygame.mixer.music.load,name)
+            self.musicName = name
+
+    def getLoadTime(self):
+        """Seconds spent loading so far, background loads included"""
+        return sum(seconds for name,seconds in self.timings)
+
+    def shutdown(self):
+        """Stop background loading, waiting for the sound being decoded"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=True,cancel_futures=True)
+            self.executor = None
@@ -0,0 +1,102 @@
+"""Sound effects played on a fixed pool of mixer channels"""
+from __future__ import division
+import pygame
+
+class SoundManager:
+    """Plays sounds by name on a pool of voices (mixer channels), so no
+    matter how much is going on the mixer never mixes more than that many
+    sounds at once. Each sound has a priority and a limit on how many
+    copies of it play together. Past its limit a sound restarts its own
+    oldest copy; when every voice is busy it takes the oldest voice of the
+    lowest priority sound, if that's no higher than its own, or isn't
+    played. Sounds played from a position outside the listener's area
+    (see setListener) aren't played at all.
+
+    Sounds come from assets (an AssetManager) as pygame Sounds, which are
+    decoded and converted to the mixer's format when loaded, so playing one
+    only mixes it."""
+    def __init__(self,assets,voices=16):
+        self.assets = assets
+        pygame.mixer.set_num_channels(voices)
+        self.channels = [pygame.mixer.Channel(i) for i in range(voices)]
+        #Per channel: name of the sound started on it and when, the count
+        #of sounds started so far
+        self.playing = [None]*voices
+        self.started = [0]*voices
+        self.count = 0
+        self.bank = {} #name -> (file,priority,limit)
+        self.listener = None #Rect in world pixels, None hears everything
+
+    def define(self,name,fileName,priority=1,limit=None):
+        """Play fileName as name. Higher priorities take voices from lower
+        ones, limit is the most copies playing at once (None for no limit)."""
+        self.bank[name] = (fileName,priority,limit)
+
+    def files(self):
+        return [fileName for fileName,priority,limit in self.bank.values()]
+
+    def getSound(self,name):
+        return self.assets.sound(self.bank[name][0])
+
+    def setListener(self,rect):
+        """Only play positioned sounds from within rect"""
+        self.listener = rect
+
+    def play(self,name,x=None,y=None):
+        """Play the sound called name, from x,y in world pixels if given.
+        Returns the channel it plays on, or None if it wasn't played."""
+        fileName,priority,limit = self.bank[name]
+        if x is not None and self.listener is not None and\
+           not self.listener.collidepoint(x,y):
+            return None
+
+        #Voice to play on: a free one, else one to take over
+        free = None
+        copies = 0
+        oldestCopy = None
+        victim = None
+        victimPriority = priority
+        for i,channel in enumerate(self.channels):
+            if not channel.get_busy():
+                self.playing[i] = None
+                if free is None:
+                    free = i
+                continue
+            playing = self.playing[i]
+            if playing == name:
+                copies += 1
+                if oldestCopy is None or self.started[i] < self.started[oldestCopy]:
+                    oldestCopy = i
+            if playing is None:
+                continue #Not ours, leave it alone
+            playingPriority = self.bank[playing][1]
+            if playingPriority < victimPriority or (playingPriority == victimPriority and
+               (victim is None or self.started[i] < self.started[victim])):
+                victim = i
+                victimPriority = playingPriority
+        if limit is not None and copies >= limit:
+            voice = oldestCopy
+        elif free is not None:
+            voice = free
+        else:
+            voice = victim
+        if voice is None:
+            return None
+
+        channel = self.channels[voice]
+        channel.play(self.assets.sound(fileName))
+        self.count += 1
+        self.playing[voice] = name
+        self.started[voice] = self.count
+        return channel
+
+    def stop(self,name=None):
+        """Stop every copy of name playing, or every sound"""
+        for i,channel in enumerate(self.channels):
+            if self.playing[i] is not None and (name is None or self.playing[i] == name):
+                channel.stop()
+                self.playing[i] = None
+
+    def getBusy(self):
+        """Number of voices playing"""
+        return sum(1 for channel in self.channels if channel.get_busy())
@@ -0,0 +1,237 @@
+"""Benchmarks of the hot paths, run with SDL's dummy drivers so no window
+or sound card is needed. Everything is seeded, so results from different
+commits can be compared:
+
+    python bench.py --output before.json
+    ...change things...
+    python bench.py --baseline before.json
+
+Each result is the best of a few repeats, in seconds per call of the
+benchmark; perOp divides that by the operations one call does. A benchmark
+that fails is recorded with its error and the others still run. With
+--baseline, benchmarks more than --threshold slower than the baseline
+are reported. The exit status is 1 if any failed or regressed.
+"""
+from __future__ import division
+import os
+os.environ.setdefault("SDL_VIDEODRIVER","dummy")
+os.environ.setdefault("SDL_AUDIODRIVER","dummy")
+import argparse
+import collections
+import json
+import platform
+import random
+import sys
+import timeit
+import traceback
+import numpy
+import pygame
+import levelgen
+import game
+from game import Map,Simulation,Bullets,Application
+from vector import Vector
+
+SEED = 1
+
+#name -> function returning (callable to time, calls per repeat, ops per call)
+benchmarks = collections.OrderedDict()
+
+def benchmark(name):
+    def register(function):
+        benchmarks[name] = function
+        return function
+    return register
+
+def makeSimulation(visibilityBudget=0):
+    level = Map(levelData=levelgen.generate(seed=SEED),visibilityBudget=visibilityBudget)
+    return Simulation(level)
+
+def floorPoints(level,count,rng):
+    """Random pixel positions on floor tiles"""
+    floors = numpy.argwhere(level.data == Map.FLOOR).tolist()
+    points = []
+    for i in range(count):
+        x,y = rng.choice(floors)
+        points.append((x*Map.tilesize+rng.randint(0,Map.tilesize-1),
+                       y*Map.tilesize+rng.randint(0,Map.tilesize-1)))
+    return points
+
+def mapBenchmark(size,number):
+    def setup():
+        return (lambda: Map(xSize=size,ySize=size,seed=SEED)),number,1
+    return setup
+
+benchmark("Map 80x80")(mapBenchmark(80,20))
+benchmark("Map 250x250")(mapBenchmark(250,5))
+benchmark("Map 1000x1000")(mapBenchmark(1000,1))
+
+@benchmark("collideLevel")
+def collideLevel():
+    sim = makeSimulation()
+    rng = random.Random(SEED)
+    moves = [(pygame.Rect(x,y,33,32),rng.choice((-1,0,1)),rng.choice((-1,0,1)))
+             for x,y in floorPoints(sim.level,1000,rng)]
+    direction = Vector()
+    def run():
+        for rect,dx,dy in moves:
+            sim.collideLevel(rect,direction.set(dx,dy))
+    return run,20,len(moves)
+
+def canSeeBenchmark(visibilityBudget):
+    def setup():
+        sim = makeSimulation(visibilityBudget)
+        rng = random.Random(SEED)
+        turrets = list(sim.level.turrets)
+        reach = game.Turret.rangeTiles*Map.tilesize
+        checks = []
+        for i in range(1000):
+            turret = rng.choice(turrets)
+            checks.append((turret,turret.x+rng.randint(-reach,reach),
+                           turret.y+rng.randint(-reach,reach)))
+        player = sim.player
+        def run():
+            for turret,x,y in checks:
+                player.x = x
+                player.y = y
+                turret.canSeePlayer(sim)
+        run() #Builds the visibility tables
+        return run,20,len(checks)
+    return setup
+
+benchmark("Turret.canSeePlayer traced")(canSeeBenchmark(0))
+benchmark("Turret.canSeePlayer tables")(canSeeBenchmark(None))
+
+def bulletsBenchmark(count,number):
+    def setup():
+        sim = makeSimulation()
+        for turret in sim.level.turrets:
+            turret.health = 10**9 #Nothing changes between runs
+        rng = random.Random(SEED)
+        template = Bullets(count)
+        centerX,centerY = sim.player.rect.center
+        for i in range(count):
+            direction = Vector(rng.uniform(-1,1),rng.uniform(-1,1)).normalizeInPlace()
+            template.spawn((centerX+rng.uniform(-1500,1500),centerY+rng.uniform(-1500,1500)),
+                           direction,rng.random() < 0.1)
+        bullets = sim.bullets = Bullets(count)
+        def run():
+            bullets.count = count
+            for name in Bullets.fields:
+                getattr(bullets,name)[:count] = getattr(template,name)[:count]
+            bullets.update(Simulation.tickLength,sim)
+            sim.health = 100
+            del sim.events[:]
+        return run,number,count
+    return setup
+
+benchmark("Bullets.update 10")(bulletsBenchmark(10,2000))
+benchmark("Bullets.update 1000")(bulletsBenchmark(1000,500))
+benchmark("Bullets.update 10000")(bulletsBenchmark(10000,100))
+
+@benchmark("Vector")
+def vector():
+    rng = random.Random(SEED)
+    vectors = [Vector(rng.uniform(-10,10),rng.uniform(-10,10)) for i in range(1000)]
+    def run():
+        total = Vector()
+        for v in vectors:
+            w = (v+total)*0.5-v
+            total += w.normalize()
+            total *= 0.9
+            v.dot(w)
+    return run,50,len(vectors)
+
+def drawBenchmark(dirtyRects,pipelined=False):
+    def setup():
+        app = Application(dirtyRects=dirtyRects,levelOptions=dict(seed=SEED),
+                          pipelined=pipelined)
+        app.gameInit()
+        app.levels.shutdown()
+        player = app.sim.player
+        startX,startY = player.x,player.y
+        frame = [0]
+        def run():
+            #Walk back and forth so the dirty path scrolls every frame
+            frame[0] += 1
+            player.move(startX+11*(frame[0]%20),startY)
+            app.cameraX = player.x+player.rect.width//2-app.width//2
+            app.cameraY = player.y+player.rect.height//2-app.height//2
+            app.draw()
+        run()
+        return run,100,1
+    return setup
+
+benchmark("Application.draw")(drawBenchmark(False))
+benchmark("Application.draw dirty rects")(drawBenchmark(True))
+benchmark("Application.draw render thread")(drawBenchmark(False,True))
+
+def run(names,repeat=5):
+    results = collections.OrderedDict()
+    for name in names:
+        random.seed(SEED)
+        try:
+            function,number,ops = benchmarks[name]()
+            seconds = min(timeit.repeat(function,number=number,repeat=repeat))/number
+        except Exception as error:
+            traceback.print_exc()
+            results[name] = {"error":"%s: %s" % (type(error).__name__,error)}
+            sys.stdout.write("%-32s FAILED %s\n" % (name,results[name]["error"]))
+            continue
+        finally:
+            sys.stdout.flush()
+        results[name] = {"seconds":seconds,"perOp":seconds/ops,"ops":ops}
+        sys.stdout.write("%-32s %12.3f ms %12.3f us/op\n" % (name,seconds*1000,
+                                                                seconds/ops*1e6))
+        sys.stdout.flush()
+    return results
+
+def compare(results,baseline,threshold):
+    """Names of the benchmarks more than threshold (0.2 is 20%) slower than
+    in baseline"""
+    regressions = []
+    for name,result in results.items():
+        if name not in baseline or "error" in result or "error" in baseline[name]:
+            continue
+        ratio = result["seconds"]/baseline[name]["seconds"]
+        flag = ""
+        if ratio > 1+threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        sys.stdout.write("%-32s %6.2fx%s\n" % (name,ratio,flag))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FoxHunt benchmarks")
+    parser.add_argument("names",nargs="*",metavar="NAME",
+                        help="only run benchmarks whose name contains NAME")
+    parser.add_argument("--list",action="store_true",help="list the benchmarks")
+    parser.add_argument("--repeat",type=int,default=5,help="repeats, the best one counts")
+    parser.add_argument("--output",metavar="FILE",help="write the results as JSON")
+    parser.add_argument("--baseline",metavar="FILE",
+                        help="compare with results written by --output")
+    parser.add_argument("--threshold",type=float,default=0.2,
+                        help="slowdown counted as a regression, 0.2 is 20%%")
+    args = parser.parse_args()
+
+    if args.list:
+        sys.stdout.write("\n".join(benchmarks)+"\n")
+        sys.exit()
+    names = [name for name in benchmarks
+             if not args.names or any(part in name for part in args.names)]
+    results = run(names,args.repeat)
+    failed = [name for name,result in results.items() if "error" in result]
+    if args.output:
+        with open(args.output,"w") as stream:
+            json.dump({"python":platform.python_version(),
+                       "pygame":pygame.version.ver,
+                       "numpy":numpy.__version__,
+                       "machine":platform.machine(),
+                       "seed":SEED,
+                       "results":results},stream,indent=1)
+    if args.baseline:
+        with open(args.baseline) as stream:
+            baseline = json.load(stream)["results"]
+        if compare(results,baseline,args.threshold):
+            sys.exit(1)
+    if failed:
+        sys.exit(1)
@@ -3,394 +3,1218 @@ import pygame
 import sys
 import math
 import random
-import sys
+import collections
+import argparse
+import timeit
+import heapq
+import json
+import numpy
+import pickle
+import threading
+import zlib
+from vector import Vector
+from assets import AssetManager
+from audio import SoundManager
+from replay import Recorder,Replay,inputBits,setDirection
+import levelgen
 
-class Vector:
-    def __init__(self,x=0,y=0):
-        self.x = x
-        self.y = y
-    
-    def getMagnitude(self):
-        return math.sqrt(self.x**2+self.y**2)
+#Images, sounds and fonts, each loaded the first time it's used
+assets = AssetManager()
 
-    def normalize(self):
-        try:
-            return Vector(self.x/self.getMagnitude(),
-                          self.y/self.getMagnitude())
-        except ZeroDivisionError:
-            return Vector()
-
-    def __sub__(self,other):
-        if isinstance(other,Vector):
-            return Vector(self.x-other.x,self.y-other.y)
-        else:
-            raise TypeError
+class RotationCache:
+    """Copies of a sprite rotated to a fixed number of evenly spaced angles.
+    Angles are rounded to the nearest step, so rotating to almost the same
+    angle again reuses the frame instead of calling transform.rotate."""
+    caches = {} #(sprite,steps) -> RotationCache, see forSprite
 
-    def __add__(self,other):
-        if isinstance(other,Vector):
-            return Vector(self.x+other.x,self.y+other.y)
-        else:
-            raise TypeError
-    def __radd__(self,other):
-        return self.__add__(other)
+    def __init__(self,sprite,steps=64):
+        if steps < 1:
+            raise ValueError("a sprite needs at least one rotation step, not %d" % steps)
+        self.sprite = sprite
+        self.steps = steps
+        self.frames = [None]*steps
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def forSprite(sprite,steps=64):
+        """The cache shared by everything rotating this sprite"""
+        key = (sprite,steps)
+        cache = RotationCache.caches.get(key)
+        if cache is None:
+            cache = RotationCache.caches[key] = RotationCache(sprite,steps)
+        return cache
 
-    def __mul__(self,other):
-        if isinstance(other,Vector):
-            return Vector(self.x*other.x,self.y*other.y)
+    def getIndex(self,angle):
+        """Frame index for an angle in degrees, anticlockwise"""
+        return int(round(angle*self.steps/360.0))%self.steps
+
+    def getFrame(self,index):
+        frame = self.frames[index]
+        if frame is None:
+            self.misses += 1
+            frame = pygame.transform.rotate(self.sprite,index*360.0/self.steps)
+            self.frames[index] = frame
         else:
-            return Vector(self.x*other,self.y*other)
-    def __rmul__(self,other):
-        return self.__mul__(other)
-        
-    def __str__(self):
-        return "("+str(self.x)+","+str(self.y)+")"
-        
-    def __eq__(self,other):
-        try:
-            if self.x == other.x and self.y == other.y:
-                return True
-            else:
-                return False
-        except:
-            return False
-    def __req__(self,other):
-        return self.__eq__(other)
-    
-    def __ne__(self,other):
-        try:
-            if self.x != other.x or self.y != other.y:
-                return True
-            else:
-                return False
-        except:
-            return False
+            self.hits += 1
+        return frame
 
-    def dot(a,b):
-        if not isinstance(a,Vector) or not isinstance(b,Vector):
-            raise TypeError
-        return a.x*b.x + a.y*b.y
+    def get(self,angle):
+        return self.getFrame(self.getIndex(angle))
+
+    def prerender(self):
+        """Render every frame now rather than on first use"""
+        for index in range(self.steps):
+            if self.frames[index] is None:
+                self.frames[index] = pygame.transform.rotate(self.sprite,
+                                                             index*360.0/self.steps)
 
 class Entity(object):
     def __init__(self,sprite):
         self.x = 0
         self.y = 0
+        #Position before the last simulation step, see lerp
+        self.lastX = 0
+        self.lastY = 0
         self.velocity = Vector()
         if sprite is not None:
             self.rect = sprite.get_rect()
         else:
             self.rect = pygame.Rect(0,0,1,1)
         self.sprite = sprite
+        self.baseSprite = sprite #Unrotated, see setAngle
+        self.rotations = None
+
+    def setAngle(self,angle,steps=64):
+        """Turn the sprite angle degrees anticlockwise, keeping the center"""
+        if self.rotations is None:
+            self.rotations = RotationCache.forSprite(self.baseSprite,steps)
+        center = self.rect.center
+        self.sprite = self.rotations.get(angle)
+        self.rect = self.sprite.get_rect(center=center)
+        self.x,self.y = self.rect.topleft
 
     def update(self,dt):
-        frameVel = self.velocity*(30*dt/1000)
-        self.x += frameVel.x
-        self.y += frameVel.y
+        step = 30*dt/1000
+        self.x += self.velocity.x*step
+        self.y += self.velocity.y*step
         self.rect.x,self.rect.y = (self.x,self.y)
 
     def move(self,x,y):
-        self.x = x
-        self.y = y
+        """Put the entity at x,y, without interpolating from where it was"""
+        self.x = self.lastX = x
+        self.y = self.lastY = y
         self.rect.x,self.rect.y = (x,y)
 
+    def savePosition(self):
+        """Call before each simulation step that may move the entity"""
+        self.lastX = self.x
+        self.lastY = self.y
+
+    def lerp(self,alpha):
+        """Position alpha (0 to 1) of the way from the previous simulation
+        step to the current one, to draw it at between steps"""
+        return (self.lastX+(self.x-self.lastX)*alpha,
+                self.lastY+(self.y-self.lastY)*alpha)
+
     def getPosition(self):
         return Vector(self.x,self.y)
 
 class Turret(Entity):
-    sprite = pygame.image.load("turret.png")
-    def __init__(self):
-        #Timer, turret will fire when it reaches a certain random number
+    rangeTiles = 14 #Can't see the player further away than this
+    def __init__(self,shootTimerEnd,health):
+        #Timer, turret will fire when it reaches shootTimerEnd
         self.shootTimer = 0
-        self.shootTimerEnd = random.randint(900,1325)
-        self.health = random.randint(2,3)*50
-        super(Turret,self).__init__(Turret.sprite)
+        self.shootTimerEnd = shootTimerEnd
+        self.health = health
+        super(Turret,self).__init__(assets.image("turret.png"))
     
-    def canSeePlayer(self,app):
-        center = (self.x+self.rect.width//2,self.y+self.rect.height//2)
-        toPlayer = Vector(app.player.x+app.player.rect.width//2,
-                          app.player.y+app.player.rect.height//2)-\
-                          Vector(*center)
-        if toPlayer.getMagnitude() >= 14*Map.tilesize: #Player more than 14 tiles away
-            return False
-        toPlayer = toPlayer.normalize()
-
-        rayLength = 24
-        while rayLength < 14*Map.tilesize:
-            ray = rayLength*toPlayer
-            colliderRect = pygame.Rect(ray.x+center[0],ray.y+center[1],1,1)
-            #If the ray hits anything that isn't this turret
-            if colliderRect.collidelist([tile for tile in 
-                                         app.level.wallTiles]) != -1:
-                return False
-            if colliderRect.colliderect(app.player.rect):
-                return True
-            rayLength += 24
-        return True
+    def canSeePlayer(self,sim):
+        return sim.level.turretCanSee(self,sim.player.x+sim.player.rect.width//2,
+                                      sim.player.y+sim.player.rect.height//2)
+
+    def fire(self,sim):
+        """Called by the TurretScheduler when the timer runs out"""
+        if self.canSeePlayer(sim):
+            self.shoot(sim)
+        self.shootTimer = 0
+        self.shootTimerEnd = sim.random.randint(900,1500)
 
-    def update(self,dt,app):
-        self.shootTimer += dt
-        if self.shootTimer >= self.shootTimerEnd:
-            if self.canSeePlayer(app):
-                self.shoot(app)
-            self.shootTimer = 0
-            self.shootTimerEnd = random.randint(900,1500)
+    def hit(self,damage,sim):
+        self.health -= damage
         if self.health <= 0:
-            app.level.turrets.remove(self)
-            app.score += 100
+            sim.level.removeTurret(self)
+            sim.score += 100
 
-    def shoot(self,app):
+    def shoot(self,sim):
         #all this arithmetic is to make a vector from the center of
         #the turret to the center of the player
-        toPlayer = Vector(app.player.x+app.player.rect.width//2,
-                          app.player.y+app.player.rect.height//2)-\
-                          Vector(self.x+self.rect.width//2,self.y+self.rect.height//2)
-        newBullet = Bullet((self.x+self.rect.width//2,self.y+self.rect.height//2),
-                           toPlayer.normalize())
-        app.bulletSound.play()
-        app.bullets.append(newBullet)
-
-class Bullet(Entity):
-    sprite = pygame.image.load("bullet.png")
-    def __init__(self,origin,direction,playerFired=False):
-        self.playerFired = playerFired
-        left = Vector(-1,0)
-        #Angle to rotate bullet sprite
-        angle = math.acos(Vector.dot(left,direction))*(180/math.pi)
-        if direction.y < 0:
-            angle = -angle
-        self.sprite = pygame.transform.rotate(Bullet.sprite,angle)
-        self.velocity = 22*direction
-        self.x = origin[0]
-        self.y = origin[1]
-        self.rect = self.sprite.get_rect()
-
-    def update(self,dt,app):
-        if self.rect.collidelist(app.level.wallTiles) != -1:
-            app.bullets.remove(self)
-        elif self.rect.colliderect(app.player.rect) and not self.playerFired:
-            app.damageSound.play()
-            app.health -= random.randint(7,15)
-            app.bullets.remove(self)
-        elif self.playerFired:
-            turretHit = self.rect.collidelist([turret.rect for turret in app.level.turrets])
-            if turretHit != -1: #if a turret was hit
-                app.bullets.remove(self)
-                app.level.turrets[turretHit].health -= 50
-                
-        super(Bullet,self).update(dt)
-
-class Room:
-    def __init__(self,level):
-        self.xSize = random.randint(4,10)
-        self.ySize = random.randint(4,10)
-        self.randomizePos(level)
-
-    def randomizePos(self,level):
-        self.x = random.randint(1,level.xSize-self.xSize-1)
-        self.y = random.randint(1,level.ySize-self.ySize-1)
-        self.rect = pygame.Rect(self.x,self.y,self.xSize,self.ySize)
+        centerX = self.x+self.rect.width//2
+        centerY = self.y+self.rect.height//2
+        toPlayer = Vector(sim.player.x+sim.player.rect.width//2-centerX,
+                          sim.player.y+sim.player.rect.height//2-centerY)
+        sim.bullets.spawn((centerX,centerY),toPlayer.normalizeInPlace())
+        sim.sound("bullet",centerX,centerY)
+
+class Bullets:
+    """Every live bullet, kept as parallel numpy arrays so the whole lot is
+    moved and collided in a few array operations per frame. Dead bullets
+    are compacted out of the arrays at the end of each update."""
+    speed = 22
+    rotationSteps = 64 #Distinct angles bullets are drawn at
+    #Names of the per-bullet arrays
+    fields = ("x","y","lastX","lastY","vx","vy","width","height","playerFired","frame")
+
+    def __init__(self,capacity=64):
+        self.count = 0
+        self.x = numpy.zeros(capacity)
+        self.y = numpy.zeros(capacity)
+        #Position before the last update, drawing interpolates from there
+        self.lastX = numpy.zeros(capacity)
+        self.lastY = numpy.zeros(capacity)
+        self.vx = numpy.zeros(capacity)
+        self.vy = numpy.zeros(capacity)
+        self.width = numpy.zeros(capacity,dtype=numpy.int32)
+        self.height = numpy.zeros(capacity,dtype=numpy.int32)
+        self.playerFired = numpy.zeros(capacity,dtype=bool)
+        #Index of each bullet's sprite in the rotation cache
+        self.frame = numpy.zeros(capacity,dtype=numpy.int16)
+        self.rotations = RotationCache.forSprite(assets.image("bullet.png"),
+                                                Bullets.rotationSteps)
+
+    def grow(self):
+        capacity = 2*len(self.x)
+        for name in Bullets.fields:
+            old = getattr(self,name)
+            new = numpy.zeros(capacity,dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self,name,new)
+
+    def spawn(self,origin,direction,playerFired=False):
+        """Fire a bullet from origin (pixels) along the unit Vector direction"""
+        if self.count == len(self.x):
+            self.grow()
+        #Angle to rotate bullet sprite, it points left unrotated
+        angle = math.degrees(math.atan2(direction.y,-direction.x))
+        frame = self.rotations.getIndex(angle)
+        sprite = self.rotations.getFrame(frame)
+        i = self.count
+        self.x[i] = self.lastX[i] = origin[0]
+        self.y[i] = self.lastY[i] = origin[1]
+        self.vx[i] = Bullets.speed*direction.x
+        self.vy[i] = Bullets.speed*direction.y
+        self.width[i],self.height[i] = sprite.get_size()
+        self.playerFired[i] = playerFired
+        self.frame[i] = frame
+        self.count += 1
+
+    def update(self,dt,sim):
+        n = self.count
+        if n == 0:
+            return
+        x = self.x[:n]
+        y = self.y[:n]
+        playerFired = self.playerFired[:n]
+        left = numpy.floor(x).astype(numpy.int64)
+        top = numpy.floor(y).astype(numpy.int64)
+        right = left+self.width[:n] #exclusive, like Rect.right
+        bottom = top+self.height[:n]
+
+        #Bullets are smaller than a tile, so the tiles under their corners
+        #are all the tiles they touch
+        level = sim.level
+        tilesize = Map.tilesize
+        dead = numpy.zeros(n,dtype=bool)
+        for cornerX,cornerY in ((left,top),(right-1,top),(left,bottom-1),(right-1,bottom-1)):
+            tileX = cornerX//tilesize-level.originX
+            tileY = cornerY//tilesize-level.originY
+            inside = (tileX >= 0) & (tileX < level.xSize) & (tileY >= 0) & (tileY < level.ySize)
+            dead[inside] |= level.walls[tileX[inside],tileY[inside]]
+            #Off the tiles the level holds, nothing out there to hit
+            dead |= ~inside
+
+        player = sim.player.rect
+        hitPlayer = ~dead & ~playerFired & (left < player.right) & (right > player.left) &\
+                    (top < player.bottom) & (bottom > player.top)
+        hits = int(numpy.count_nonzero(hitPlayer))
+        if hits:
+            sim.sound("damage")
+            for i in range(hits):
+                sim.health -= sim.random.randint(7,15)
+            dead |= hitPlayer
+
+        #Few bullets are the player's, ask the turret hash about each of them
+        for i in numpy.flatnonzero(~dead & playerFired):
+            rect = pygame.Rect(int(left[i]),int(top[i]),int(right[i]-left[i]),
+                               int(bottom[i]-top[i]))
+            turretsHit = level.turretHash.query(rect)
+            if turretsHit: #if a turret was hit
+                dead[i] = True
+                turretsHit[0].hit(50,sim)
+
+        if dead.any():
+            alive = ~dead
+            remaining = int(numpy.count_nonzero(alive))
+            for name in Bullets.fields:
+                array = getattr(self,name)
+                array[:remaining] = array[:n][alive]
+            n = self.count = remaining
+
+        step = 30*dt/1000
+        self.lastX[:n] = self.x[:n]
+        self.lastY[:n] = self.y[:n]
+        self.x[:n] += self.vx[:n]*step
+        self.y[:n] += self.vy[:n]*step
+
+    def getSprites(self,cameraX,cameraY,width,height,alpha=1):
+        """(sprite,screen rect) pairs of the bullets within a width x height
+        view whose top left is at cameraX,cameraY. They are drawn alpha of
+        the way from their last position to the current one."""
+        n = self.count
+        x = self.x[:n]
+        y = self.y[:n]
+        if alpha != 1:
+            lastX = self.lastX[:n]
+            lastY = self.lastY[:n]
+            x = lastX+(x-lastX)*alpha
+            y = lastY+(y-lastY)*alpha
+        left = numpy.floor(x).astype(numpy.int64)-cameraX
+        top = numpy.floor(y).astype(numpy.int64)-cameraY
+        bulletWidth = self.width[:n]
+        bulletHeight = self.height[:n]
+        onScreen = numpy.flatnonzero((left < width) & (left+bulletWidth > 0) &
+                                     (top < height) & (top+bulletHeight > 0))
+        frames = self.rotations.frames
+        frame = self.frame[:n]
+        return [(frames[frame[i]],pygame.Rect(int(left[i]),int(top[i]),
+                                        int(bulletWidth[i]),int(bulletHeight[i])))
+                for i in onScreen]
+
+    def __len__(self):
+        return self.count
+
+class SpatialHash:
+    """Broad phase for entities: buckets them by the square cells their
+    rect overlaps, so a query only looks at the entities near it"""
+    def __init__(self,cellSize):
+        self.cellSize = cellSize
+        self.cells = {} #(cx,cy) -> list of entities
+        self.entityCells = {} #entity -> cells it was inserted in
+
+    def cellsFor(self,rect):
+        size = self.cellSize
+        return [(cx,cy) for cx in range(rect.left//size,(rect.right-1)//size+1)
+                        for cy in range(rect.top//size,(rect.bottom-1)//size+1)]
+
+    def insert(self,entity):
+        cells = self.cellsFor(entity.rect)
+        self.entityCells[entity] = cells
+        for cell in cells:
+            self.cells.setdefault(cell,[]).append(entity)
+
+    def remove(self,entity):
+        for cell in self.entityCells.pop(entity):
+            bucket = self.cells[cell]
+            bucket.remove(entity)
+            if not bucket:
+                del self.cells[cell]
+
+    def update(self,entity):
+        """Call after a moving entity's rect changed"""
+        if self.cellsFor(entity.rect) != self.entityCells[entity]:
+            self.remove(entity)
+            self.insert(entity)
+
+    def query(self,rect):
+        """Entities whose rect collides with rect"""
+        found = []
+        for cell in self.cellsFor(rect):
+            for entity in self.cells.get(cell,()):
+                if entity not in found and rect.colliderect(entity.rect):
+                    found.append(entity)
+        return found
+
+    def __len__(self):
+        return len(self.entityCells)
+
+class TurretScheduler:
+    """Decides which turrets fire each frame without looking at the others.
+    Awake turrets are in a heap ordered by the game time (ms) their timer
+    runs out, a frame only pops the ones that are due. Turrets further than
+    radius tiles from the player are asleep, out of the heap with their
+    timer stopped, so the heap only holds the turrets around the player.
+    Removing a turret marks its heap entry dead; dead entries are skipped
+    when popped."""
+    def __init__(self,level,radius=20):
+        self.level = level
+        #Turrets can't shoot further than their range, so that much around
+        #the player has to be awake
+        self.radius = max(radius,Turret.rangeTiles)
+        self.time = 0
+        self.heap = [] #[deadline,sequence,turret], turret is None once dead
+        self.entries = {} #awake turret -> its heap entry
+        self.sequence = 0 #Keeps turrets with the same deadline in order
+        self.dead = 0 #Dead entries in heap
+        self.awakeRect = None #Turrets touching it are awake, see follow
+        self.cell = None
+
+    def add(self,turret):
+        """A new turret, it wakes up if it's near the player"""
+        if self.awakeRect is not None and self.awakeRect.colliderect(turret.rect):
+            self.wake(turret)
+
+    def wake(self,turret):
+        deadline = self.time+max(turret.shootTimerEnd-turret.shootTimer,0)
+        entry = [deadline,self.sequence,turret]
+        self.sequence += 1
+        self.entries[turret] = entry
+        heapq.heappush(self.heap,entry)
+
+    def sleep(self,turret):
+        """Take a turret out of the heap, storing its timer back in it"""
+        entry = self.entries.pop(turret,None)
+        if entry is None:
+            return
+        turret.shootTimer = turret.shootTimerEnd-max(entry[0]-self.time,0)
+        entry[2] = None
+        self.dead += 1
+        if self.dead > 32 and self.dead > len(self.heap)//2:
+            self.heap = [entry for entry in self.heap if entry[2] is not None]
+            heapq.heapify(self.heap)
+            self.dead = 0
+
+    remove = sleep
+
+    def follow(self,x,y):
+        """Wake the turrets around the point x,y in pixels and put the
+        others to sleep. Only does anything when x,y moved to another
+        cell of the level's turret hash."""
+        cellSize = self.level.turretHash.cellSize
+        cell = (int(x//cellSize),int(y//cellSize))
+        if cell == self.cell:
+            return
+        self.cell = cell
+        #Everything within radius of anywhere in the cell
+        margin = self.radius*Map.tilesize
+        self.awakeRect = pygame.Rect(cell[0]*cellSize-margin,cell[1]*cellSize-margin,
+                                     cellSize+2*margin,cellSize+2*margin)
+        nearby = self.level.turretHash.query(self.awakeRect)
+        nearbySet = set(nearby)
+        for turret in [turret for turret in self.entries if turret not in nearbySet]:
+            self.sleep(turret)
+        for turret in nearby:
+            if turret not in self.entries:
+                self.wake(turret)
+
+    def update(self,dt,sim):
+        """Advance game time by dt ms and fire the turrets that are due"""
+        #Turrets woken now count this frame's time too
+        self.follow(sim.player.x+sim.player.rect.width//2,
+                    sim.player.y+sim.player.rect.height//2)
+        self.time += dt
+        heap = self.heap
+        while heap and heap[0][0] <= self.time:
+            entry = heapq.heappop(heap)
+            turret = entry[2]
+            if turret is None:
+                self.dead -= 1
+                continue
+            turret.fire(sim)
+            entry = [self.time+turret.shootTimerEnd,self.sequence,turret]
+            self.sequence += 1
+            self.entries[turret] = entry
+            heapq.heappush(heap,entry)
+
+    def __len__(self):
+        """Number of awake turrets"""
+        return len(self.entries)
+
+class VisibilityTable:
+    """Bitset of the floor tiles a turret can see within its range, so
+    checking whether it sees a tile is a single lookup. Tiles of other
+    turrets count as floor, they turn into it when the turret is destroyed."""
+    def __init__(self,level,turret):
+        tilesize = Map.tilesize
+        centerX = turret.x+turret.rect.width//2
+        centerY = turret.y+turret.rect.height//2
+        self.tileX = int(centerX//tilesize)
+        self.tileY = int(centerY//tilesize)
+        self.radius = Turret.rangeTiles
+        self.size = 2*self.radius+1
+        self.bits = bytearray((self.size*self.size+7)//8)
+        maxDistance = (Turret.rangeTiles*tilesize)**2
+        for y in range(self.size):
+            tileY = self.tileY-self.radius+y
+            localY = tileY-level.originY
+            if not 0 <= localY < level.ySize:
+                continue
+            for x in range(self.size):
+                tileX = self.tileX-self.radius+x
+                localX = tileX-level.originX
+                if not 0 <= localX < level.xSize or\
+                   level.tiles[localX*level.ySize+localY] not in (Map.FLOOR,Map.TURRET):
+                    continue
+                #Tiles are judged by their center
+                targetX = tileX*tilesize+tilesize//2
+                targetY = tileY*tilesize+tilesize//2
+                if (targetX-centerX)**2+(targetY-centerY)**2 < maxDistance and\
+                   level.lineOfSight(centerX,centerY,targetX,targetY):
+                    index = y*self.size+x
+                    self.bits[index>>3] |= 1<<(index&7)
+
+    def canSee(self,tileX,tileY):
+        x = tileX-self.tileX+self.radius
+        y = tileY-self.tileY+self.radius
+        if not (0 <= x < self.size and 0 <= y < self.size):
+            return False
+        index = y*self.size+x
+        return bool(self.bits[index>>3] & 1<<(index&7))
+
+    def getMemory(self):
+        """Size of the bitset in bytes"""
+        return len(self.bits)
 
 class Map:
     #Tile types
-    EMPTY = 0
-    FLOOR = 1
-    WALL = 2
-    TURRET = 3
+    EMPTY = levelgen.EMPTY
+    FLOOR = levelgen.FLOOR
+    WALL = levelgen.WALL
+    TURRET = levelgen.TURRET
 
-    tilesize = 48 #tile size in pixels
-    def __init__(self):
-        self.xSize = 80
-        self.ySize = 80
-
-        self.numRooms = random.randint(6,12)
-        self.rooms = []
-        self.data = []
-        self.wallTiles = []
-        self.turrets = []
-
-        #Initialize list of lists data[row][column]
-        for x in range(self.xSize):
-            self.data.append([Map.EMPTY for y in range(self.ySize)])
-
-        for i in range(self.numRooms):
-            newRoom = Room(self)
-            self.rooms.append(newRoom)
-
-        for i in range(self.numRooms):
-            room = self.rooms[i]
-            if room.rect.collidelist([r.rect for r in self.rooms if r is not room]) != -1:
-                room.randomizePos(self)
-                i -= 1
-
-        #Create rooms
-        for room in self.rooms:
-            for x in range(room.xSize):
-                for y in range(room.ySize):
-                    self.data[x+room.x][y+room.y] = Map.FLOOR
-
-        spawnRoom = self.rooms[random.randint(0,self.numRooms-1)]
-        self.spawnX = spawnRoom.x*self.tilesize + (spawnRoom.xSize*self.tilesize)//2
-        self.spawnY = spawnRoom.y*self.tilesize + (spawnRoom.ySize*self.tilesize)//2
-
-        foxRoom = spawnRoom
-        while foxRoom == spawnRoom:
-            foxRoom = self.rooms[random.randint(0,self.numRooms-1)]
-        self.foxX = foxRoom.x*self.tilesize + (foxRoom.xSize*self.tilesize)//2
-        self.foxY = foxRoom.y*self.tilesize + (foxRoom.ySize*self.tilesize)//2
-
-        #Create hallways between rooms
-        for i in range(self.numRooms-1):
-            room1 = self.rooms[i]
-            room2 = self.rooms[i+1]
-            
-            xCenter1 = room1.x+room1.xSize//2
-            xCenter2 = room2.x+room2.xSize//2
-            yCenter1 = room1.y+room1.ySize//2
-            yCenter2 = room2.y+room2.ySize//2
-            
-            if abs(xCenter1-xCenter2) > room1.xSize:
-                if (xCenter1-xCenter2) < 0: #second room is to the right
-                    hallwayStart = (room1.x+room1.xSize,yCenter1)
-                else:
-                    hallwayStart = (room1.x-1,yCenter1)
+    tilesize = levelgen.TILESIZE #tile size in pixels
+    def __init__(self,visibilityBudget=0,xSize=80,ySize=80,numRooms=None,
+                 seed=None,debug=False,levelData=None,activityRadius=20):
+        """Build the level described by levelData, or generate one here from
+        the size, room count and seed (see levelgen.generate)"""
+        if levelData is None:
+            levelData = levelgen.generate(xSize,ySize,numRooms,seed)
+        start = timeit.default_timer()
+        self.seed = levelData.seed
+        self.xSize = levelData.xSize
+        self.ySize = levelData.ySize
+        self.rooms = levelData.rooms
+        self.numRooms = len(self.rooms)
+        self.spawnX,self.spawnY = levelData.spawnX,levelData.spawnY
+        self.foxX,self.foxY = levelData.foxX,levelData.foxY
+        #Seconds each generation stage took
+        self.timings = collections.OrderedDict(levelData.timings)
+
+        #Turret visibility tables are built on first use while they fit in
+        #this many bytes, past it turrets trace their line of sight instead.
+        #0 turns them off, None means no limit.
+        self.visibilityBudget = visibilityBudget
+        self.visibility = {} #turret -> VisibilityTable
+        self.visibilityMemory = 0
+
+        #One byte per tile, tile x,y is at x*ySize+y. Loops doing one tile
+        #at a time index tiles, data is a numpy view of the same bytes
+        #indexed data[x,y] for whole-map operations.
+        self.tiles = levelData.tiles
+        self.data = levelData.getArray()
+        self.walls = self.data == Map.WALL #Indexed [x,y]
+        self._wallTiles = None
+        #World tile position of tile 0,0 above. Always 0,0 here, a
+        #StreamingMap only holds part of its world.
+        self.originX = self.originY = 0
+
+        #Turret -> None, a dict so removing one is cheap and they stay in order
+        self.turrets = {}
+        self.turretHash = SpatialHash(4*Map.tilesize)
+        #Turrets further than activityRadius tiles from the player sleep
+        self.scheduler = TurretScheduler(self,activityRadius)
+        for x,y,shootTimerEnd,health in levelData.turrets:
+            newTurret = Turret(shootTimerEnd,health)
+            newTurret.move(x,y)
+            self.addTurret(newTurret)
+        self.timings["objects"] = timeit.default_timer()-start
+
+        if debug:
+            self.dump()
+            for stage,seconds in self.timings.items():
+                sys.stdout.write("%s: %.2f ms\n" % (stage,seconds*1000))
+
+    @property
+    def wallTiles(self):
+        """Rects of every wall tile, made the first time they're asked for"""
+        if self._wallTiles is None:
+            tilesize = self.tilesize
+            self._wallTiles = [pygame.Rect((x+self.originX)*tilesize,
+                                           (y+self.originY)*tilesize,tilesize,tilesize)
+                               for x,y in numpy.argwhere(self.walls).tolist()]
+        return self._wallTiles
+
+    def dump(self,stream=sys.stdout):
+        """Write the map as ASCII art"""
+        levelgen.dump(self.data,stream)
+
+    def addTurret(self,turret):
+        self.turrets[turret] = None
+        self.turretHash.insert(turret)
+        self.scheduler.add(turret)
+
+    def removeTurret(self,turret):
+        del self.turrets[turret]
+        self.turretHash.remove(turret)
+        self.scheduler.remove(turret)
+        table = self.visibility.pop(turret,None)
+        if table is not None:
+            self.visibilityMemory -= table.getMemory()
+        #The tile is drawn as floor either way, so the terrain stays as is
+        self.data[turret.rect.x//Map.tilesize-self.originX,
+                  turret.rect.y//Map.tilesize-self.originY] = Map.FLOOR
+
+    def follow(self,x,y):
+        """Called with the player's position every frame, a Map holds all of
+        its tiles so there is nothing to do"""
+        pass
+
+    def rectHitsWall(self,rect):
+        """Whether a rect in pixels overlaps a wall tile. Only looks at the
+        tiles under the rect instead of every wall."""
+        tilesize = Map.tilesize
+        left = max(rect.left//tilesize-self.originX,0)
+        right = min((rect.right-1)//tilesize-self.originX,self.xSize-1)
+        top = max(rect.top//tilesize-self.originY,0)
+        bottom = min((rect.bottom-1)//tilesize-self.originY,self.ySize-1)
+        tiles = self.tiles
+        for x in range(left,right+1):
+            column = x*self.ySize
+            for y in range(top,bottom+1):
+                if tiles[column+y] == Map.WALL:
+                    return True
+        return False
+
+    def lineOfSight(self,x0,y0,x1,y1):
+        """Whether the segment between two points in pixels crosses no wall.
+        Visits each tile the segment passes through exactly once
+        (Amanatides & Woo grid traversal), so thin walls are never skipped."""
+        tilesize = Map.tilesize
+        if self.originX or self.originY:
+            #Trace relative to the tiles held
+            offsetX = self.originX*tilesize
+            offsetY = self.originY*tilesize
+            x0 -= offsetX
+            x1 -= offsetX
+            y0 -= offsetY
+            y1 -= offsetY
+        tileX = int(x0//tilesize)
+        tileY = int(y0//tilesize)
+        dx = x1-x0
+        dy = y1-y0
+        #tMax is how far along the segment (0 to 1) the next tile boundary
+        #on that axis is, tDelta how far apart those boundaries are
+        if dx > 0:
+            stepX = 1
+            tDeltaX = tilesize/dx
+            tMaxX = ((tileX+1)*tilesize-x0)/dx
+        elif dx < 0:
+            stepX = -1
+            tDeltaX = -tilesize/dx
+            tMaxX = (tileX*tilesize-x0)/dx
+        else:
+            stepX = 0
+            tDeltaX = tMaxX = float("inf")
+        if dy > 0:
+            stepY = 1
+            tDeltaY = tilesize/dy
+            tMaxY = ((tileY+1)*tilesize-y0)/dy
+        elif dy < 0:
+            stepY = -1
+            tDeltaY = -tilesize/dy
+            tMaxY = (tileY*tilesize-y0)/dy
+        else:
+            stepY = 0
+            tDeltaY = tMaxY = float("inf")
+
+        steps = abs(int(x1//tilesize)-tileX)+abs(int(y1//tilesize)-tileY)
+        tiles = self.tiles
+        for i in range(steps+1):
+            if 0 <= tileX < self.xSize and 0 <= tileY < self.ySize and\
+               tiles[tileX*self.ySize+tileY] == Map.WALL:
+                return False
+            if tMaxX < tMaxY:
+                tMaxX += tDeltaX
+                tileX += stepX
             else:
-                if (yCenter1-yCenter2) < 0: #second room is higher
-                    hallwayStart = (xCenter1,room1.y-1)
-                else:
-                    hallwayStart = (xCenter1,room1.y+room1.ySize)
-            
-            endX = hallwayStart[0]
-            
-            for x in range(abs(hallwayStart[0]-xCenter2)):
-                if hallwayStart[0] < xCenter2:
-                    self.data[hallwayStart[0]+x][yCenter1] = Map.FLOOR
-                    endX += 1
-                else:
-                    self.data[hallwayStart[0]-x][yCenter1] = Map.FLOOR
-                    endX -= 1
-
-            for y in range(abs(hallwayStart[1]-yCenter2)):
-                if hallwayStart[1] < yCenter2:
-                    self.data[endX][hallwayStart[1]+y] = Map.FLOOR
-                else:
-                    self.data[endX][hallwayStart[1]-y] = Map.FLOOR
-            
-        #Yet another loop through the rooms. This time we're
-        #adding turrets
-        for room in self.rooms:
-            if room == spawnRoom:
-                continue
-            for tile in range(room.xSize*room.ySize):
-                if random.random() < 1/15:
-                    tileX = room.x+tile%room.xSize
-                    tileY = room.y+tile//room.xSize
-                    self.data[tileX][tileY] = Map.TURRET
-                    newTile = pygame.Rect(tileX*self.tilesize,tileY*self.tilesize,
-                                          self.tilesize,self.tilesize)
-                    newTurret = Turret()
-                    newTurret.move(tileX*Map.tilesize,tileY*Map.tilesize)
-                    self.turrets.append(newTurret)
-
-        #Finally add the walls
-        for y in range(1,self.ySize-1):
-            for x in range(1,self.xSize-1):
-                if self.data[x][y] != Map.EMPTY and self.data[x][y] != Map.WALL:
-                    adjacents = []
-                    #Positions of all the adjacent tiles, so they may be looped through
-                    adjacents.append((x-1,y-1))
-                    adjacents.append((x-1,y+1))
-                    adjacents.append((x-1,y))
-                    adjacents.append((x,y-1))
-                    adjacents.append((x,y+1))
-                    adjacents.append((x+1,y+1))
-                    adjacents.append((x+1,y-1))
-                    adjacents.append((x+1,y))
-                    for pos in adjacents:
-                        if self.data[pos[0]][pos[1]] == Map.EMPTY:
-                            self.data[pos[0]][pos[1]] = Map.WALL
-                            newTile = pygame.Rect(pos[0]*self.tilesize,pos[1]*self.tilesize,self.tilesize,self.tilesize)
-                            self.wallTiles.append(newTile)
-                x += 1
-            y += 1
-
-        for y in range(self.ySize):
-            for x in range(self.xSize):
-                tile = self.data[x][y]
-                #print tile,
-                if tile == Map.FLOOR:
-                    sys.stdout.write('A')
-                elif tile == Map.EMPTY:
-                    sys.stdout.write('-')
-                else:
-                    sys.stdout.write(str(tile))
-            sys.stdout.write('\n')
+                tMaxY += tDeltaY
+                tileY += stepY
+        return True
 
-class Application:
-    def __init__(self):
-        pygame.init()
-        pygame.mixer.init(44100)
+    def getVisibilityTable(self,turret):
+        """The turret's visibility table, built now if there's room for it.
+        None if the budget is used up."""
+        table = self.visibility.get(turret)
+        if table is None:
+            size = (2*Turret.rangeTiles+1)**2
+            if self.visibilityBudget is not None and\
+               self.visibilityMemory+(size+7)//8 > self.visibilityBudget:
+                return None
+            table = VisibilityTable(self,turret)
+            self.visibility[turret] = table
+            self.visibilityMemory += table.getMemory()
+        return table
 
-        self.width = 800
-        self.height = 600
-        self.screen = pygame.display.set_mode((self.width,self.height))
-        pygame.display.set_caption("FoxHunt v0.1")
-        Bullet.sprite = Bullet.sprite.convert_alpha() #This is here because it has to be done after init
-        self.bg_colour = 0,0,0
+    def turretCanSee(self,turret,x,y):
+        """Whether a turret can see the point x,y in pixels"""
+        centerX = turret.x+turret.rect.width//2
+        centerY = turret.y+turret.rect.height//2
+        if (x-centerX)**2+(y-centerY)**2 >= (Turret.rangeTiles*Map.tilesize)**2:
+            return False
+        table = self.getVisibilityTable(turret)
+        if table is None:
+            return self.lineOfSight(centerX,centerY,x,y)
+        return table.canSee(int(x//Map.tilesize),int(y//Map.tilesize))
 
-        #Entity representing the mouse, no model
-        self.mouseEntity = Entity(None)
-        self.mouseEntity.move(*pygame.mouse.get_pos())
-        #Tiles
-        self.floorTile = pygame.image.load("floor.png")
-        self.turretTile = pygame.image.load("turret.png")
-        self.wallTile = pygame.image.load("wall.png")
-
-        #Entities
-        self.player = Entity(pygame.image.load("player.png"))
-        self.fox = Entity(pygame.image.load("fox.png"))
-
-        #Sounds
-        self.bulletSound = pygame.mixer.Sound("bullet.wav")
-        self.bgm = pygame.mixer.music.load("bg.wav")
-        self.damageSound = pygame.mixer.Sound("oof.wav")
-        self.pickupSound = pygame.mixer.Sound("pickup.wav")
-        self.winSound = pygame.mixer.Sound("eb-youwin.wav")
-        self.gameOverSound = pygame.mixer.Sound("eb-loss.wav")
-        self.dieSound = pygame.mixer.Sound("159408__noirenex__life-lost-game-over.wav")
-        
-        self.foximg = pygame.image.load("foxhunt_f.png")
-        self.font = pygame.font.Font("PressStart2P.ttf",24)
-        self.state = 2
+    def rectBlocked(self,rect):
+        """Whether a rect in pixels overlaps a wall or a turret"""
+        return self.rectHitsWall(rect) or bool(self.turretHash.query(rect))
 
-    def gameInit(self):
+class StreamingMap(Map):
+    """A world of worldRegions square regions of regionSize tiles, far too
+    big to hold at once. Regions are generated from the seed and their
+    position (see levelgen.generateRegion) when the player gets near. Only
+    the 3x3 regions around the player are live: their tiles are in tiles,
+    data and walls (offset by originX,originY) and their turrets are in
+    turrets. Regions leaving that window are packed into compressed bytes,
+    with the state of their turrets, and unpacked when the player is back."""
+    @staticmethod
+    def checkRegionSize(regionSize):
+        """Raise ValueError unless regions of regionSize tiles can be cut
+        into whole terrain chunks"""
+        if regionSize <= 0 or regionSize % TerrainCache.chunkTiles:
+            raise ValueError("the region size must be a positive multiple of %d, not %d" %
+                             (TerrainCache.chunkTiles,regionSize))
+
+    @staticmethod
+    def checkWorldRegions(worldRegions):
+        """Raise ValueError unless worldRegions is a usable world size: the
+        fox is never put in the player's region, so there have to be two"""
+        width,height = worldRegions
+        if width < 1 or height < 1 or width*height < 2:
+            raise ValueError("the world needs at least two regions, not %dx%d" % (width,height))
+
+    def __init__(self,visibilityBudget=0,worldRegions=(32,32),regionSize=64,
+                 seed=None,numRooms=None,debug=False,activityRadius=20):
+        StreamingMap.checkRegionSize(regionSize)
+        StreamingMap.checkWorldRegions(worldRegions)
+        levelgen.checkRooms(numRooms)
+        if seed is None:
+            seed = random.randrange(1<<32)
+        self.seed = seed
+        self.worldRegions = worldRegions
+        self.regionSize = regionSize
+        self.numRooms = numRooms #Per region
+        self.debug = debug
+        self.timings = collections.OrderedDict()
+
+        self.visibilityBudget = visibilityBudget
+        self.visibility = {}
+        self.visibilityMemory = 0
+
+        self.xSize = self.ySize = 3*regionSize
+        self.tiles = bytearray(self.xSize*self.ySize)
+        self.data = numpy.frombuffer(self.tiles,dtype=numpy.uint8)\
+                         .reshape(self.xSize,self.ySize)
+        self.walls = numpy.zeros((self.xSize,self.ySize),dtype=bool)
+        self._wallTiles = None
+        self.originX = self.originY = 0
+
+        self.turrets = {}
+        self.turretHash = SpatialHash(4*Map.tilesize)
+        self.scheduler = TurretScheduler(self,activityRadius)
+        self.regionTurrets = {} #live (regionX,regionY) -> its turrets
+        self.packed = {} #(regionX,regionY) -> bytes, see pack
+        self.center = None #Region the window is around
+
+        #The player starts in the middle of the world and the fox is in
+        #another region picked from the seed
+        self.spawnRegion = (worldRegions[0]//2,worldRegions[1]//2)
+        spawn = self.generateRegion(self.spawnRegion)
+        self.spawnX,self.spawnY = spawn.spawnX,spawn.spawnY
+        rng = random.Random(seed)
+        foxRegion = self.spawnRegion
+        while foxRegion == self.spawnRegion:
+            foxRegion = (rng.randrange(worldRegions[0]),rng.randrange(worldRegions[1]))
+        fox = self.generateRegion(foxRegion)
+        self.foxX,self.foxY = fox.foxX,fox.foxY
+        self.rooms = spawn.rooms
+
+        self.follow(self.spawnX,self.spawnY)
+
+    def generateRegion(self,region):
+        return levelgen.generateRegion(self.seed,region[0],region[1],self.regionSize,
+                                       self.worldRegions,self.numRooms,
+                                       spawn=region == self.spawnRegion)
+
+    def regionSlice(self,region):
+        """Where a live region's tiles are in data"""
+        startX = region[0]*self.regionSize-self.originX
+        startY = region[1]*self.regionSize-self.originY
+        return (slice(startX,startX+self.regionSize),slice(startY,startY+self.regionSize))
+
+    def follow(self,x,y):
+        """Move the window of live regions when the point x,y in pixels (the
+        player) enters another region"""
+        regionPixels = self.regionSize*Map.tilesize
+        center = (min(max(int(x//regionPixels),0),self.worldRegions[0]-1),
+                  min(max(int(y//regionPixels),0),self.worldRegions[1]-1))
+        if center != self.center:
+            self.setCenter(center)
+
+    def setCenter(self,center):
+        start = timeit.default_timer()
+        wanted = set((center[0]+dx,center[1]+dy) for dx in (-1,0,1) for dy in (-1,0,1)
+                     if 0 <= center[0]+dx < self.worldRegions[0] and
+                        0 <= center[1]+dy < self.worldRegions[1])
+        kept = {}
+        for region in list(self.regionTurrets):
+            if region in wanted:
+                kept[region] = self.data[self.regionSlice(region)].copy()
+            else:
+                self.pack(region)
+        loaded = 0
+        self.center = center
+        self.originX = (center[0]-1)*self.regionSize
+        self.originY = (center[1]-1)*self.regionSize
+        self.data[:] = Map.EMPTY
+        for region in wanted:
+            if region in kept:
+                self.data[self.regionSlice(region)] = kept[region]
+            else:
+                self.unpack(region)
+                loaded += 1
+        self.walls[:] = self.data == Map.WALL
+        self._wallTiles = None
+        #Tables of turrets near the old edge were traced without the tiles
+        #past it
+        self.visibility.clear()
+        self.visibilityMemory = 0
+        self.timings["regions"] = timeit.default_timer()-start
+        if self.debug:
+            sys.stdout.write("region %d,%d: %d loaded, %d packed (%d bytes) in %.2f ms\n" %
+                             (center[0],center[1],loaded,len(self.packed),
+                              self.getPackedMemory(),self.timings["regions"]*1000))
+
+    def pack(self,region):
+        """Take a live region out of the window, compressing its tiles and
+        the state of its turrets into packed"""
+        tiles = self.data[self.regionSlice(region)].tobytes()
+        turrets = []
+        for turret in self.regionTurrets.pop(region):
+            del self.turrets[turret]
+            self.turretHash.remove(turret)
+            self.scheduler.remove(turret) #Stores its timer back in it
+            turrets.append((turret.x,turret.y,turret.shootTimer,
+                            turret.shootTimerEnd,turret.health))
+        self.packed[region] = zlib.compress(pickle.dumps((tiles,turrets),2))
+
+    def unpack(self,region):
+        """Put a region in the window, from packed if it was there before
+        or generated otherwise"""
+        if region in self.packed:
+            tiles,turrets = pickle.loads(zlib.decompress(self.packed.pop(region)))
+            tiles = numpy.frombuffer(tiles,dtype=numpy.uint8)\
+                         .reshape(self.regionSize,self.regionSize)
+        else:
+            levelData = self.generateRegion(region)
+            tiles = levelData.getArray()
+            turrets = [(x,y,0,shootTimerEnd,health)
+                       for x,y,shootTimerEnd,health in levelData.turrets]
+        self.data[self.regionSlice(region)] = tiles
+        live = self.regionTurrets[region] = []
+        for x,y,shootTimer,shootTimerEnd,health in turrets:
+            newTurret = Turret(shootTimerEnd,health)
+            newTurret.shootTimer = shootTimer
+            newTurret.move(x,y)
+            live.append(newTurret)
+            self.addTurret(newTurret)
+
+    def removeTurret(self,turret):
+        regionPixels = self.regionSize*Map.tilesize
+        self.regionTurrets[(turret.rect.x//regionPixels,
+                            turret.rect.y//regionPixels)].remove(turret)
+        Map.removeTurret(self,turret)
+
+    def getPackedMemory(self):
+        """Bytes taken by the packed regions"""
+        return sum(len(packed) for packed in self.packed.values())
+
+def describeLevel(level,numRooms=None):
+    """Options buildLevel makes level again from, numRooms being the room
+    count it was generated with (a Map doesn't know if that was random)"""
+    if isinstance(level,StreamingMap):
+        description = {"world":{"worldRegions":list(level.worldRegions),
+                                "regionSize":level.regionSize,
+                                "numRooms":level.numRooms,"seed":level.seed}}
+    else:
+        description = {"level":{"xSize":level.xSize,"ySize":level.ySize,
+                                "numRooms":numRooms,"seed":level.seed}}
+    #Which turrets are paused changes their timers, and visibility tables
+    #look from the middle of the player's tile where tracing doesn't
+    description["activityRadius"] = level.scheduler.radius
+    description["visibilityBudget"] = level.visibilityBudget
+    return description
+
+def buildLevel(description,**options):
+    """The level describeLevel described, options are the other Map or
+    StreamingMap arguments"""
+    options = dict(options)
+    options["activityRadius"] = description["activityRadius"]
+    options["visibilityBudget"] = description["visibilityBudget"]
+    if "world" in description:
+        options.update(description["world"])
+        options["worldRegions"] = tuple(options["worldRegions"])
+        return StreamingMap(**options)
+    return Map(levelData=levelgen.generate(**description["level"]),**options)
+
+class TerrainCache:
+    """Pre-renders the static tiles of a Map into square chunk surfaces
+    so a frame only blits the few chunks overlapping the camera"""
+    chunkTiles = 16 #chunk size in tiles
+    minChunks = 12 #fewest baked chunks kept around before the oldest is dropped
+
+    def __init__(self,level,floorTile,wallTile,bg_colour,viewSize=(800,600)):
+        self.level = level
+        self.floorTile = floorTile
+        self.wallTile = wallTile
+        self.bg_colour = bg_colour
+        self.chunkSize = self.chunkTiles*Map.tilesize
+        #Enough for every chunk a viewSize view can overlap, and a row and
+        #a column more for when it moves, or each frame would rebake them
+        columns = -(-viewSize[0]//self.chunkSize)+1
+        rows = -(-viewSize[1]//self.chunkSize)+1
+        self.maxChunks = max(TerrainCache.minChunks,(columns+1)*(rows+1))
+        #(cx,cy) -> Surface, or None for chunks without any tiles. Chunks
+        #are in world coordinates, see Map.originX
+        self.chunks = collections.OrderedDict()
+        self.origin = (level.originX,level.originY)
+
+    def buildChunk(self,cx,cy):
+        tilesize = Map.tilesize
+        level = self.level
+        startX = cx*self.chunkTiles-level.originX
+        startY = cy*self.chunkTiles-level.originY
+        if not (0 <= startX < level.xSize and 0 <= startY < level.ySize):
+            return None
+        chunk = level.data[startX:startX+self.chunkTiles,
+                           startY:startY+self.chunkTiles]
+        floors = numpy.argwhere((chunk == Map.FLOOR)|(chunk == Map.TURRET)).tolist()
+        walls = numpy.argwhere(chunk == Map.WALL).tolist()
+        if not floors and not walls:
+            return None
+        surface = pygame.Surface((self.chunkSize,self.chunkSize)).convert()
+        surface.fill(self.bg_colour)
+        surface.blits([(self.floorTile,(x*tilesize,y*tilesize)) for x,y in floors],False)
+        surface.blits([(self.wallTile,(x*tilesize,y*tilesize)) for x,y in walls],False)
+        return surface
+
+    def getChunk(self,cx,cy):
+        key = (cx,cy)
+        try:
+            chunk = self.chunks.pop(key)
+        except KeyError:
+            chunk = self.buildChunk(cx,cy)
+        self.chunks[key] = chunk #Most recently used goes last
+        while len(self.chunks) > self.maxChunks:
+            self.chunks.popitem(last=False)
+        return chunk
+
+    def invalidate(self,tileX,tileY):
+        """Call when a tile changes so its chunk is baked again"""
+        self.chunks.pop((tileX//self.chunkTiles,tileY//self.chunkTiles),None)
+
+    def getBlits(self,cameraX,cameraY,area):
+        """(chunk,screen position) pairs of the chunks overlapping the
+        screen rect area"""
+        cameraX = int(cameraX)
+        cameraY = int(cameraY)
+        level = self.level
+        if (level.originX,level.originY) != self.origin:
+            #Tiles were streamed in where there were none before
+            self.origin = (level.originX,level.originY)
+            for key in [key for key,chunk in self.chunks.items() if chunk is None]:
+                del self.chunks[key]
+        size = self.chunkSize
+        chunkTiles = self.chunkTiles
+        firstX = max((area.left+cameraX)//size,level.originX//chunkTiles)
+        firstY = max((area.top+cameraY)//size,level.originY//chunkTiles)
+        lastX = min((area.right+cameraX-1)//size,(level.originX+level.xSize-1)//chunkTiles)
+        lastY = min((area.bottom+cameraY-1)//size,(level.originY+level.ySize-1)//chunkTiles)
+        blits = []
+        for cx in range(firstX,lastX+1):
+            for cy in range(firstY,lastY+1):
+                chunk = self.getChunk(cx,cy)
+                if chunk is not None:
+                    blits.append((chunk,(cx*size-cameraX,cy*size-cameraY)))
+        return blits
+
+class TextCache:
+    """Rendered text surfaces keyed by font, string and colour, and whether
+    they're premultiplied (for BLEND_PREMULTIPLIED, needs the display).
+    Only the maxSize most recently used ones are kept."""
+    def __init__(self,maxSize=64):
+        self.maxSize = maxSize
+        self.surfaces = collections.OrderedDict()
+
+    def render(self,font,text,colour=(255,255,255),premultiplied=False):
+        key = (font,text,colour,premultiplied)
+        try:
+            surface = self.surfaces.pop(key)
+        except KeyError:
+            surface = font.render(text,True,colour)
+            if premultiplied:
+                #premul_alpha mangles the padded rows of font surfaces, so
+                #convert_alpha them to a plain display format copy first
+                surface = surface.convert_alpha().premul_alpha()
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.maxSize:
+            self.surfaces.popitem(last=False)
+        return surface
+
+class ProfilePhase:
+    """Times one phase for a Profiler, see Profiler.phase"""
+    __slots__ = ("profiler","name","start")
+
+    def __init__(self,profiler,name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+
+    def __exit__(self,*exception):
+        self.profiler.record(self.name,self.start,timeit.default_timer()-self.start)
+
+class NullPhase:
+    """What Profiler.phase gives back when profiling is off"""
+    def __enter__(self):
+        pass
+
+    def __exit__(self,*exception):
+        pass
+
+class Profiler:
+    """Times the phases of each frame. Code marks a phase with
+
+        with profiler.phase("bullets"):
+
+    which does nothing but hand back a shared NullPhase while the profiler
+    is off. While it's on, the average time of each phase and the times of
+    the last frames are kept for the overlay (see Application.drawProfile),
+    and with trace set every phase is also kept for writeTrace."""
+    history = 120 #Frame times kept for the graph
+    smoothing = 0.1 #Weight of the newest frame in the phase averages
+    nullPhase = NullPhase()
+
+    def __init__(self,enabled=False,trace=False):
+        self.enabled = enabled
+        self.trace = trace
+        self.events = [] #(name,start,duration) in seconds, see writeTrace
+        self.frameTimes = collections.deque(maxlen=self.history) #seconds
+        self.phaseTimes = collections.OrderedDict() #phase -> seconds this frame
+        self.averages = collections.OrderedDict() #phase -> ms
+        self.frameStart = None
+
+    def phase(self,name):
+        if not self.enabled:
+            return Profiler.nullPhase
+        return ProfilePhase(self,name)
+
+    def record(self,name,start,duration):
+        self.phaseTimes[name] = self.phaseTimes.get(name,0)+duration
+        if self.trace:
+            self.events.append((name,start,duration))
+
+    def beginFrame(self):
+        if self.enabled:
+            self.frameStart = timeit.default_timer()
+            self.phaseTimes.clear()
+
+    def endFrame(self):
+        if not self.enabled or self.frameStart is None:
+            return
+        duration = timeit.default_timer()-self.frameStart
+        self.frameTimes.append(duration)
+        if self.trace:
+            self.events.append(("frame",self.frameStart,duration))
+        names = list(self.averages)+[name for name in self.phaseTimes
+                                     if name not in self.averages]
+        for name in names: #In the order first seen
+            milliseconds = self.phaseTimes.get(name,0)*1000
+            self.averages[name] = self.averages.get(name,milliseconds)*(1-self.smoothing)+\
+                                  milliseconds*self.smoothing
+        self.frameStart = None
+
+    def writeTrace(self,path):
+        """Write the recorded phases as a Chrome trace (chrome://tracing,
+        Perfetto), one complete event per phase"""
+        events = [{"name":name,"ph":"X","ts":start*1e6,"dur":duration*1e6,
+                   "pid":1,"tid":1}
+                  for name,start,duration in self.events]
+        with open(path,"w") as stream:
+            json.dump({"traceEvents":events,"displayTimeUnit":"ms"},stream)
+
+class Hud:
+    """Lives, health, score and signal strength. The text is composited
+    into a single surface, which is only redone when one of those values
+    changes; the signal bar, which changes nearly every frame, is drawn
+    over it on its own."""
+    barColour = (0,255,0)
+    barAlpha = 191 #75% opaque
+
+    def __init__(self,font,textCache,width):
+        self.font = font
+        self.textCache = textCache
+        self.width = width
+        self.values = None
+        self.textValues = None
+        self.surface = None
+        self.rect = pygame.Rect(0,0,0,0)
+        self.barRect = pygame.Rect(0,0,0,0)
+        bar = pygame.Surface((400,30),pygame.SRCALPHA)
+        bar.fill(self.barColour+(self.barAlpha,))
+        self.bar = bar.premul_alpha()
+
+    def update(self,lives,health,score,signalWidth):
+        """Composite the HUD if it changed, returns whether it did"""
+        values = (lives,health,score,signalWidth)
+        if values == self.values:
+            return False
+        self.values = values
+
+        render = self.textCache.render
+        signalText = render(self.font,"Signal",premultiplied=True)
+        signalTextRect = signalText.get_rect()
+        signalTextRect = signalTextRect.move(self.width//2-\
+                                             signalTextRect.width//2,0)
+        barRect = pygame.Rect(0,0,signalWidth,30)
+        self.barRect = barRect.move(self.width//2-barRect.width//2,
+                                    signalTextRect.height+5)
+        if (lives,health,score) == self.textValues:
+            return True
+        self.textValues = (lives,health,score)
+
+        #Premultiplied text is kept in the cache
+        livesText = render(self.font,"Lives: "+str(lives),premultiplied=True)
+        livesTextRect = livesText.get_rect()
+        healthText = render(self.font,"Health: "+str(health),premultiplied=True)
+        healthTextRect = healthText.get_rect()
+        healthTextRect = healthTextRect.move(0,livesTextRect.height)
+
+        scoreText = render(self.font,"Score: "+str(score),premultiplied=True)
+        scoreTextRect = scoreText.get_rect()
+        scoreTextRect = scoreTextRect.move(self.width-scoreTextRect.width,0)
+
+        height = max(healthTextRect.bottom,signalTextRect.height+5+30)
+        if self.surface is None or self.surface.get_height() != height:
+            self.surface = pygame.Surface((self.width,height),pygame.SRCALPHA)
+            self.rect = self.surface.get_rect()
+        #Composited with premultiplied alpha so it blends onto the screen
+        #the same way the text would drawn straight to it
+        self.surface.fill((0,0,0,0))
+        for text,rect in ((scoreText,scoreTextRect),(livesText,livesTextRect),
+                          (healthText,healthTextRect),(signalText,signalTextRect)):
+            self.surface.blit(text,rect,special_flags=pygame.BLEND_PREMULTIPLIED)
+        return True
+
+    def draw(self,screen):
+        screen.blit(self.surface,self.rect,special_flags=pygame.BLEND_PREMULTIPLIED)
+        barRect = self.barRect
+        if barRect.width > 0:
+            screen.blit(self.bar,barRect,barRect.move(-barRect.x,-barRect.y),
+                        special_flags=pygame.BLEND_PREMULTIPLIED)
+
+class Simulation:
+    """One game without a screen or speakers: the level, the player, the
+    fox, the bullets and the score. Application plays one with the
+    keyboard and mouse and draws it, headless.py runs them as fast as
+    they go. Sounds the game makes are added to events for whoever runs it
+    to play, as (name,x,y): name is "bullet", "damage", "pickup" or "die"
+    and x,y where it came from in pixels, None for the player's own.
+    Everything random during the game comes from random, seeded with seed,
+    so the same level, seed and input give the same game (see replay)."""
+    tickLength = 1000/30 #ms per step, see tick
+    playerSpeed = 11 #pixels per step
+
+    def __init__(self,level,lives=3,profiler=None,seed=None):
+        self.level = level
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.profiler = profiler or Profiler()
+        self.player = Entity(assets.image("player.png"))
+        self.player.move(level.spawnX,level.spawnY)
+        self.fox = Entity(assets.image("fox.png"))
+        self.fox.move(level.foxX,level.foxY)
+        self.bullets = Bullets()
         self.score = 0
-        self.lives = 3
-        self.state = 0
-        self.win = False
+        self.lives = lives
         self.health = 100
+        self.win = False
+        self.over = False
+        self.ticks = 0
+        self.events = []
+
+    def sound(self,name,x=None,y=None):
+        """Add the sound name to events, made at x,y in pixels if given"""
+        self.events.append((name,x,y))
+
+    def shoot(self,targetX,targetY):
+        """The player fires at the point targetX,targetY in pixels"""
+        origin = (self.player.x+self.player.rect.width//2,
+                  self.player.y+self.player.rect.height//2)
+        direction = Vector(targetX-origin[0],targetY-origin[1]).normalizeInPlace()
+        self.bullets.spawn(origin,direction,True)
+        self.sound("bullet")
+
+    def tick(self,direction,dt=None):
+        """Advance the game by one step, with the player moving along
+        direction (a Vector, each axis -1, 0 or 1, changed if blocked).
+        Steps are tickLength ms; dt only affects timers and bullets."""
+        if dt is None:
+            dt = Simulation.tickLength
+        self.ticks += 1
+        profiler = self.profiler
+        with profiler.phase("collide"):
+            self.player.savePosition()
+            self.collideLevel(self.player.rect,direction)
+            self.player.x += Simulation.playerSpeed*direction.x
+            self.player.y += Simulation.playerSpeed*direction.y
+            self.player.update(dt)
+        with profiler.phase("turrets"):
+            self.level.scheduler.update(dt,self)
+        with profiler.phase("bullets"):
+            self.bullets.update(dt,self)
+
+        if self.player.rect.colliderect(self.fox.rect):
+            self.sound("pickup")
+            self.win = True
+            self.over = True
+            self.score += 1250
+
+        if self.lives < 0:
+            self.over = True
+
+        if self.health < 0:
+            self.sound("die")
+            self.player.move(self.level.spawnX,self.level.spawnY)
+            self.lives -= 1
+            self.health = 100
+        self.level.follow(self.player.x,self.player.y)
 
-        self.cameraX = 0
-        self.cameraY = 0
-        
-        self.level = Map()
-        self.player.move(self.level.spawnX,self.level.spawnY)
-        self.fox.move(self.level.foxX,self.level.foxY)
-        self.bullets = []
-        
     def collideLevel(self,obj,direction):
         obj = pygame.Rect(obj)
         collideX = False
         collideY = False
+        speed = Simulation.playerSpeed
 
-        obj.x += 11*direction.x
+        obj.x += speed*direction.x
         #If it collided with a wall or a turret while moving on the X axis
-        if obj.collidelist(self.level.wallTiles) != -1 or\
-           obj.collidelist([turret.rect for turret in self.level.turrets]) != -1:
+        if self.level.rectBlocked(obj):
             collideX = True
-        obj.x -= 11*direction.x
-        obj.y += 11*direction.y
+        obj.x -= speed*direction.x
+        obj.y += speed*direction.y
         #do this again but in the Y direction
-        if obj.collidelist(self.level.wallTiles) != -1 or\
-           obj.collidelist([turret.rect for turret in self.level.turrets]) != -1:
+        if self.level.rectBlocked(obj):
             collideY = True
 
         #kill movement if it would have hit a wall
@@ -399,219 +1223,872 @@ class Application:
         if collideY:
             direction.y = 0
 
-    def signalBar(self):
-        distance = (Vector(self.player.x,self.player.y)-\
-                    Vector(self.fox.x,self.fox.y)).getMagnitude()
-        strength = min(12000.0/distance**2,1.0)
-        width = (400*strength)
-        bar = pygame.Surface((width,30))
-        bar.fill((0,255,0))
-        bar.set_alpha(0.75*255)
-        return bar
+class Frame:
+    """Everything a frame of the game shows, taken by Application.snapshot
+    so it can be drawn while the game goes on (see Renderer). Positions are
+    screen pixels, and nothing in it changes after it's taken."""
+    def __init__(self):
+        self.cameraX = self.cameraY = 0
+        self.terrain = [] #(chunk,position), see TerrainCache.getBlits
+        self.statics = [] #(sprite,rect) of the turrets and the fox on screen
+        self.sprites = [] #(sprite,rect) of the moving entities
+        self.hud = None #(lives,health,score,signal width)
+        self.profile = None #(frame times,phase averages) with the overlay on
+        self.repaint = False #Redo the whole screen, for the dirty rects
+
+class Renderer:
+    """Draws frames on a thread of its own while the game runs ahead,
+    frame N being drawn while N+1 is simulated. There are two Frames, one
+    being drawn and one being filled in by the game (getBack); submit hands
+    the filled in one over once the other is done and they swap. pygame
+    lets go of the GIL while it blits, so the two overlap. The display
+    isn't safe to use off the main thread, so a drawn frame is presented
+    from wait, which submit calls before handing over the next one."""
+    def __init__(self,draw,present):
+        self.draw = draw #Called with each Frame on the thread
+        self.present = present #Called on the main thread with what draw returned
+        self.frames = [Frame(),Frame()]
+        self.back = 0
+        self.drawing = None #Frame handed over and not drawn yet
+        self.presentPending = False
+        self.presentRects = None
+        self.error = None
+        self.running = True
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run,name="render")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def getBack(self):
+        """The Frame to fill in next"""
+        return self.frames[self.back]
+
+    def submit(self,frame):
+        """Hand frame over to be drawn, waits for the last one"""
+        self.wait()
+        with self.condition:
+            self.drawing = frame
+            self.condition.notify_all()
+        self.back ^= 1
+
+    def wait(self):
+        """Wait until the frame handed over has been drawn, and present it"""
+        with self.condition:
+            while self.drawing is not None:
+                self.condition.wait()
+            error = self.error
+            self.error = None
+            pending = self.presentPending
+            self.presentPending = False
+        if error is not None:
+            raise error
+        if pending:
+            self.present(self.presentRects)
 
     def run(self):
-        running = True
-        clock = pygame.time.Clock()
+        while True:
+            with self.condition:
+                while self.drawing is None and self.running:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                frame = self.drawing
+            try:
+                self.presentRects = self.draw(frame)
+                self.presentPending = True
+            except Exception as error:
+                self.error = error
+            with self.condition:
+                self.drawing = None
+                self.condition.notify_all()
+
+    def stop(self):
+        self.wait()
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+
+class State:
+    """One screen of the Application, see Application.run. handle gets
+    each input event, update the ms since the last frame and render draws
+    and presents the frame. A state moves on with app.setState."""
+    fps = None #Frame rate limit, None for the Application's
+
+    def __init__(self,app):
+        self.app = app
+
+    def enter(self):
+        pass
+
+    def leave(self):
+        pass
+
+    def handle(self,event):
+        pass
+
+    def update(self,dt):
+        pass
+
+    def render(self):
+        pass
+
+class MenuState(State):
+    """The start screen, a click starts a game"""
+    def enter(self):
+        pygame.mixer.music.stop()
+
+    def handle(self,event):
+        if event.type == pygame.MOUSEBUTTONDOWN:
+            self.app.setState(PlayState(self.app))
+
+    def render(self):
+        app = self.app
+        app.screen.fill((0,0,0))
+        playText = app.textCache.render(app.font,"Click to play")
+        playTextRect = playText.get_rect()
+        playTextRect = playTextRect.move(app.width//2-playTextRect.width//2,
+                                         app.height//3)
+
+        attribText = app.textCache.render(app.sysfont,"John Brooks | http://www.fastquake.com/")
+        attribTextRect = attribText.get_rect()
+        attribTextRect = attribTextRect.move(app.width//2-attribTextRect.width//2,
+                                             app.height-attribTextRect.height)
+
+        app.screen.blit(attribText,attribTextRect)
+        app.screen.blit(playText,playTextRect)
+        if app.showProfile:
+            app.drawProfile(app.profileSnapshot())
+        app.present()
+
+class PlayState(State):
+    """A game being played, in fixed steps with frames drawn in between"""
+    def enter(self):
+        assets.music("bg.wav") #Streamed as it plays
+        pygame.mixer.music.rewind()
+        pygame.mixer.music.play(-1) #Play looping music
+        self.app.gameInit() #Initialize game world
+
+    def handle(self,event):
+        app = self.app
+        if event.type == pygame.MOUSEBUTTONDOWN and app.freezeTime <= 0 and\
+           app.replay is None:
+            mousePos = app.getMousePos()
+            #Whole pixels, so a recording holds exactly what was shot at
+            x = int(round(mousePos[0]+app.cameraX))
+            y = int(round(mousePos[1]+app.cameraY))
+            if app.recorder is not None:
+                app.recorder.shoot(x,y)
+            app.sim.shoot(x,y)
+            app.playSounds()
+
+    def leave(self):
+        self.app.stopRecording()
+        if self.app.renderer is not None:
+            self.app.renderer.wait() #Other states draw here
+
+    def update(self,dt):
+        app = self.app
+        if app.fastReplay:
+            dt = app.tickLength #A step every frame however long frames take
+        if app.freezeTime > 0:
+            #Just died, the game waits for the sound to end
+            app.freezeTime -= dt
+            return
+        if app.sim.over:
+            if app.replay is not None:
+                app.running = False
+            else:
+                app.setState(EndState(app))
+            return
+        app.accumulator += dt
+        while app.accumulator >= app.tickLength and not app.sim.over and\
+              app.freezeTime <= 0:
+            app.accumulator -= app.tickLength
+            app.tick(app.tickLength)
+        app.alpha = min(app.accumulator/app.tickLength,1)
+
+        playerX,playerY = app.sim.player.lerp(app.alpha)
+        app.cameraX = playerX+app.sim.player.rect.width//2-app.width//2
+        app.cameraY = playerY+app.sim.player.rect.height//2-app.height//2
+        app.mouseEntity.move(*app.getMousePos())
+
+    def render(self):
+        self.app.draw()
+
+class EndState(State):
+    """The game over or win screen fading in over the last frame. The
+    jingle starts after a second and clicks go back to the menu after two."""
+    fps = 30 #The fade darkens a little more every frame
+    fadeout = 5000
 
-        while running:
-            #Normal gameplay state
-            if self.state == 0:
+    def enter(self):
+        pygame.mixer.music.stop()
+        if self.app.sim.win:
+            self.sound = "win"
+        else:
+            self.sound = "gameOver"
+        self.timer = 0
+        self.played = False
+        self.fadeSurface = pygame.Surface((self.app.width,self.app.height))
+        self.fadeSurface.fill((0,0,0))
+        self.fadeSurface.set_alpha(0)
+
+    def leave(self):
+        self.app.audio.stop(self.sound)
+
+    def handle(self,event):
+        if event.type == pygame.MOUSEBUTTONDOWN and self.timer > 2000:
+            self.app.setState(MenuState(self.app))
+
+    def update(self,dt):
+        self.timer += dt
+        if self.timer > 1000 and not self.played:
+            self.played = True
+            self.app.audio.play(self.sound)
+
+    def render(self):
+        app = self.app
+        fadeout = EndState.fadeout
+        self.fadeSurface.set_alpha(min(int(self.timer*(255/fadeout)),255))
+        app.screen.blit(self.fadeSurface,self.fadeSurface.get_rect())
+        if self.timer > fadeout/3:
+            if not app.sim.win:
+                GOtext = app.textCache.render(app.font,"Game Over")
+            else:
+                GOtext = app.textCache.render(app.font,"Fox get! You win!")
+                foximg = assets.image("foxhunt_f.png")
+                foximgRect = foximg.get_rect()
+                foximgRect = foximgRect.move(app.width//2-foximgRect.width//2,app.height//3+10)
+                app.screen.blit(foximg,foximgRect)
+            clickText = app.textCache.render(app.font,"Click to return to start screen")
+
+            goTextRect = GOtext.get_rect()
+            clickTextRect = clickText.get_rect()
+            clickTextRect = clickTextRect.move(app.width/2.0-clickTextRect.width/2.0,
+                                               app.height/4.0-clickTextRect.height/2.0+\
+                                               goTextRect.height)
+            goTextRect = goTextRect.move(app.width/2.0-goTextRect.width/2.0,
+                                         app.height/4.0-goTextRect.height/2.0-\
+                                         clickTextRect.height)
+            scoreText = app.textCache.render(app.font,"Score: "+str(app.sim.score))
+            scoreTextRect = scoreText.get_rect()
+            scoreTextRect = scoreTextRect.move(app.width-scoreTextRect.width,0)
+
+            app.screen.blit(scoreText,scoreTextRect)
+            app.screen.blit(GOtext,goTextRect)
+            app.screen.blit(clickText,clickTextRect)
+        if app.showProfile:
+            app.drawProfile(app.profileSnapshot())
+        app.present()
+
+class Application:
+    def __init__(self,dirtyRects=False,resolution=(800,600),windowSize=None,
+                 scaleMode="stretch",levelOptions=None,mapOptions=None,
+                 levelProcesses=False,worldOptions=None,fps=60,profileTrace=None,
+                 voices=16,audioBuffer=512,record=None,replay=None,fastReplay=False,
+                 pipelined=False):
+        self.startTime = timeit.default_timer() #Until the first frame, see present
+        #A small buffer keeps shots in time with the picture
+        pygame.mixer.pre_init(44100,-16,2,audioBuffer)
+        pygame.init()
+        pygame.mixer.init()
+
+        #Everything is drawn at this internal resolution
+        self.width,self.height = resolution
+        if windowSize is None:
+            windowSize = resolution
+        self.window = pygame.display.set_mode(windowSize)
+        pygame.display.set_caption("FoxHunt v0.1")
+        self.setupPresentation(scaleMode)
+        assets.displayReady() #Images load converted to the window's format from here on
+        RotationCache.forSprite(assets.image("bullet.png"),Bullets.rotationSteps).prerender()
+        self.bg_colour = 0,0,0
+        #The game runs in fixed steps of tickLength ms whatever the frame
+        #rate, see Simulation. Frames are drawn at up to fps (0 for no limit), between the
+        #last two steps. A frame taking longer than maxFrameTime only
+        #advances the game by maxFrameTime, so a stall doesn't turn into a
+        #long burst of steps.
+        self.clock = pygame.time.Clock()
+        self.tickLength = Simulation.tickLength
+        self.fps = fps
+        self.maxFrameTime = 250
+        self.accumulator = 0 #Time not simulated yet, in ms
+        self.alpha = 1 #How far between steps frames are drawn, see Entity.lerp
+        #Only repaint what changed between frames, see drawDirty
+        self.dirtyRects = dirtyRects
+        self.lastCamera = None
+        self.lastRects = []
+        self.lastStatics = set() #Screen rects of last frame's turrets and fox
+        self.repaint = True #The next frame redraws everything, see drawDirty
+        #Frames are drawn from snapshots of the game (see Frame), on a thread
+        #of their own if pipelined (see Renderer)
+        self.frame = Frame()
+        self.renderer = None
+        if pipelined:
+            #Its phases would race with the game's, the game times the
+            #handover instead
+            quiet = Profiler()
+            self.renderer = Renderer(lambda frame: self.drawFrame(frame,quiet),
+                                     self.present)
+        #Levels are generated in the background from levelOptions (see
+        #levelgen.generate), mapOptions are the other Map arguments. With
+        #worldOptions every game is a StreamingMap made from them instead.
+        self.mapOptions = mapOptions or {}
+        self.levelOptions = levelOptions or {}
+        self.worldOptions = worldOptions
+        #record is a file to record the first game in, replay one to play
+        #back instead of the keyboard and mouse (see replay). fastReplay
+        #plays back a step every frame instead of in real time.
+        self.recordPath = record
+        self.recorder = None
+        self.replay = None
+        self.fastReplay = fastReplay
+        if replay is not None:
+            self.replay = Replay(replay)
+            self.levels = None
+        elif worldOptions is None:
+            self.levels = levelgen.LevelProvider(levelOptions,processes=levelProcesses)
+        else:
+            self.levels = None
+
+        #Entity representing the mouse, no model
+        self.mouseEntity = Entity(None)
+        self.mouseEntity.move(*self.getMousePos())
+        self.moveDirection = Vector() #Reused every frame for WASD input
+        #Sounds, by Simulation.events name. They're decoded on a thread
+        #while the menu is up, the ones needed first first. Images and
+        #fonts load when first drawn.
+        self.audio = SoundManager(assets,voices)
+        self.audio.define("bullet","bullet.wav",priority=1,limit=4)
+        self.audio.define("damage","oof.wav",priority=2,limit=2)
+        self.audio.define("pickup","pickup.wav",priority=3,limit=1)
+        self.audio.define("die","159408__noirenex__life-lost-game-over.wav",priority=3,limit=1)
+        self.audio.define("win","eb-youwin.wav",priority=4,limit=1)
+        self.audio.define("gameOver","eb-loss.wav",priority=4,limit=1)
+        self.audibleMargin = 200 #Pixels off screen sounds are still heard from
+        assets.loadInBackground(self.audio.files())
+
+        self.font = assets.font("PressStart2P.ttf",24)
+        self.sysfont = assets.sysFont("monospace",24)
+        self.textCache = TextCache()
+        self.hud = Hud(self.font,self.textCache,self.width)
+        #F3 shows the profiler overlay. With profileTrace (a file name) the
+        #profiler runs all along and writes a trace there at the end.
+        self.profileTrace = profileTrace
+        self.profiler = Profiler(enabled=profileTrace is not None,
+                                 trace=profileTrace is not None)
+        self.showProfile = False
+        self.profileFont = assets.sysFont("monospace",14)
+        self.profileText = None #Redone every quarter second, see drawProfile
+        self.profileTextTime = 0
+        lineHeight = self.profileFont.get_linesize()
+        self.profileRect = pygame.Rect(0,self.height-14*lineHeight-50,
+                                       260,14*lineHeight+50)
+        self.state = None #See setState
+        self.freezeTime = 0 #ms the game stays paused for after a death
+
+    def gameInit(self):
+        self.cameraX = 0
+        self.cameraY = 0
+        
+        if self.replay is not None:
+            header = self.replay.header
+            level = buildLevel(header,**self.mapOptions)
+            seed = header["seed"]
+        else:
+            if self.worldOptions is None:
+                level = Map(levelData=self.levels.get(),**self.mapOptions)
+                seed = self.levelOptions.get("seed")
+            else:
+                options = dict(self.mapOptions)
+                options.update(self.worldOptions)
+                level = StreamingMap(**options)
+                seed = self.worldOptions.get("seed")
+            if seed is None:
+                seed = random.randrange(1<<32)
+        self.sim = Simulation(level,profiler=self.profiler,seed=seed)
+        if self.recordPath is not None:
+            header = describeLevel(level,self.levelOptions.get("numRooms"))
+            header["seed"] = seed
+            self.recorder = Recorder(self.recordPath,header)
+            self.recordPath = None #Only the first game
+        self.terrain = TerrainCache(level,assets.image("floor.png"),
+                                    assets.image("wall.png"),self.bg_colour,
+                                    (self.width,self.height))
+        self.repaint = True #Menus drew over the screen
+        self.accumulator = 0
+        self.alpha = 1
+        self.freezeTime = 0
+        self.clock.tick() #Time spent in the menu isn't game time
+        
+    def setupPresentation(self,scaleMode):
+        """Decide how the internal screen surface reaches the window.
+        scaleMode is "stretch" to fill the window, "smooth" to fill it
+        with filtering or "integer" for the largest whole multiple that
+        fits (nearest neighbour, keeps the pixel art crisp)"""
+        windowWidth,windowHeight = self.window.get_size()
+        self.scaleMode = scaleMode
+        self.scaleFactor = None #Set when the scaling is a whole multiple
+        if (windowWidth,windowHeight) == (self.width,self.height):
+            #Draw straight to the display, no scaling needed
+            self.screen = self.window
+            self.presentRect = self.window.get_rect()
+            self.presentSurface = None
+            self.scaleFactor = 1
+            return
+
+        self.screen = pygame.Surface((self.width,self.height)).convert()
+        if scaleMode == "integer":
+            factor = min(windowWidth//self.width,windowHeight//self.height)
+            if factor >= 1:
+                self.scaleFactor = factor
+                size = (self.width*factor,self.height*factor)
+            else:
+                #Window too small for a whole multiple, shrink keeping aspect
+                fit = min(windowWidth/self.width,windowHeight/self.height)
+                size = (int(self.width*fit),int(self.height*fit))
+        else:
+            size = (windowWidth,windowHeight)
+        self.presentRect = pygame.Rect((0,0),size)
+        self.presentRect.center = self.window.get_rect().center
+        self.presentSurface = self.window.subsurface(self.presentRect)
+        self.window.fill((0,0,0)) #Letterbox bars
+
+    def present(self,rects=None):
+        """Show the screen surface in the window, all of it or only rects"""
+        if self.startTime is not None:
+            if assets.verbose:
+                sys.stdout.write("%8.2f ms  first frame, %.2f ms of it loading\n" %
+                                 ((timeit.default_timer()-self.startTime)*1000,
+                                  assets.getLoadTime()*1000))
+            self.startTime = None
+        if self.presentSurface is None:
+            if rects is None:
+                pygame.display.flip()
+            else:
+                pygame.display.update(rects)
+            return
+
+        if rects is not None and self.scaleFactor is not None:
+            #Whole multiples scale each rect exactly, no need to do them all
+            factor = self.scaleFactor
+            windowRects = []
+            for rect in rects:
+                rect = rect.clip(self.screen.get_rect())
+                if rect.width == 0 or rect.height == 0:
+                    continue
+                windowRect = pygame.Rect(rect.x*factor,rect.y*factor,
+                                         rect.width*factor,rect.height*factor)
+                pygame.transform.scale(self.screen.subsurface(rect),windowRect.size,
+                                       self.presentSurface.subsurface(windowRect))
+                windowRects.append(windowRect.move(self.presentRect.topleft))
+            pygame.display.update(windowRects)
+            return
+
+        if self.scaleMode == "smooth":
+            pygame.transform.smoothscale(self.screen,self.presentRect.size,
+                                         self.presentSurface)
+        else:
+            pygame.transform.scale(self.screen,self.presentRect.size,
+                                   self.presentSurface)
+        pygame.display.flip()
+
+    def getMousePos(self):
+        """Mouse position in screen surface coordinates"""
+        x,y = pygame.mouse.get_pos()
+        if self.presentSurface is None:
+            return x,y
+        return ((x-self.presentRect.x)*self.width//self.presentRect.width,
+                (y-self.presentRect.y)*self.height//self.presentRect.height)
+
+    def tick(self,dt):
+        """Advance the game by one simulation step of dt ms"""
+        direction = self.moveDirection.set(0,0)
+        if self.replay is not None:
+            step = self.replay.next()
+            if step is None:
+                self.running = False #Nothing more was recorded
+                return
+            bits,shots = step
+            for x,y in shots:
+                self.sim.shoot(x,y)
+            setDirection(direction,bits)
+        else:
+            keys = pygame.key.get_pressed()
+            if keys[pygame.K_w]:
+                direction.y -= 1
+            if keys[pygame.K_s]:
+                direction.y += 1
+            if keys[pygame.K_a]:
+                direction.x -= 1
+            if keys[pygame.K_d]:
+                direction.x += 1
+        if self.recorder is not None:
+            self.recorder.step(inputBits(direction))
+        self.sim.tick(direction,dt)
+        self.playSounds()
+
+    def stopRecording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def playSounds(self):
+        """Play the sounds of the simulation's events"""
+        player = self.sim.player
+        listener = pygame.Rect(0,0,self.width,self.height)
+        listener.center = (int(player.x)+player.rect.width//2,
+                           int(player.y)+player.rect.height//2)
+        self.audio.setListener(listener.inflate(2*self.audibleMargin,2*self.audibleMargin))
+        for name,x,y in self.sim.events:
+            self.audio.play(name,x,y)
+            if name == "die":
+                #The game waits for the sound to end, see PlayState
+                self.freezeTime = self.audio.getSound("die").get_length()*1000
+                self.accumulator = 0
+        del self.sim.events[:]
+
+    def signalWidth(self):
+        """Width in pixels of the signal strength bar"""
+        dx = self.sim.player.x-self.sim.fox.x
+        dy = self.sim.player.y-self.sim.fox.y
+        strength = min(12000.0/max(dx*dx+dy*dy,1),1.0)
+        return int(400*strength)
+
+    def setState(self,state):
+        """Leave the current state for state"""
+        if self.state is not None:
+            self.state.leave()
+        self.state = state
+        state.enter()
+
+    def run(self):
+        """The main loop: every frame the state gets the events, then an
+        update with the time since the last frame, then draws"""
+        self.running = True
+        if self.replay is not None:
+            self.setState(PlayState(self))
+        else:
+            self.setState(MenuState(self))
+        profiler = self.profiler
+        frames = 0
+        start = timeit.default_timer()
+        while self.running:
+            frames += 1
+            profiler.beginFrame()
+            with profiler.phase("input"):
                 for event in pygame.event.get():
                     if event.type == pygame.QUIT:
-                        running = False
-                    if event.type == pygame.MOUSEBUTTONDOWN:
-                        origin = (self.player.x+self.player.rect.width//2,
-                                  self.player.y+self.player.rect.height//2)
-                        mousePos = pygame.mouse.get_pos()
-                        mouseX = mousePos[0]+self.cameraX
-                        mouseY = mousePos[1]+self.cameraY
-                        direction = (Vector(mouseX,mouseY)-\
-                                    Vector(origin[0],origin[1])).normalize()
-                        newBullet = Bullet(origin,direction,True)
-                        self.bulletSound.play()
-                        self.bullets.append(newBullet)
-                dt = clock.tick(30) #Limit to 30 FPS
-
-                keys = pygame.key.get_pressed()
-                direction = Vector()
-                if keys[pygame.K_w]:
-                    direction += Vector(0,-1)
-                if keys[pygame.K_s]:
-                    direction += Vector(0,1)
-                if keys[pygame.K_a]:
-                    direction += Vector(-1,0)
-                if keys[pygame.K_d]:
-                    direction += Vector(1,0)
-
-                self.collideLevel(self.player.rect,direction)
-                self.player.x += 11*direction.x#*30*dt/1000
-                self.player.y += 11*direction.y#*30*dt/1000
-
-                self.player.update(dt)
-                for turret in self.level.turrets:
-                    turret.update(dt,self)
-                for bullet in self.bullets:
-                    bullet.update(dt,self)
-                
-                if self.player.rect.colliderect(self.fox.rect):
-                    self.pickupSound.play()
-                    self.win = True
-                    self.state = 1
-                    self.score += 1250
-
-                if self.lives < 0:
-                    self.state = 1
-
-                if self.health < 0:
-                    self.dieSound.play()
-                    pygame.time.delay(int(self.dieSound.get_length()*1000))
-                    self.player.move(self.level.spawnX,self.level.spawnY)
-                    self.lives -= 1      
-                    self.health = 100              
-
-                self.cameraX = self.player.x+self.player.rect.width//2-self.width//2
-                self.cameraY = self.player.y+self.player.rect.height//2-self.height//2
-
-                self.mouseEntity.move(*pygame.mouse.get_pos())
-                self.draw()
-
-            elif self.state == 1:
-                pygame.mixer.music.stop()
-                if self.win:
-                    sound = self.winSound
-                else:
-                    sound = self.gameOverSound
-                timer = 0
-                played = False
-                endgame = True
-                fadeSurface = pygame.Surface((self.width,self.height))
-                fadeSurface.fill((0,0,0))
-                fadeSurface.set_alpha(0)
-                while endgame:
-                    if timer > 1000 and not played:
-                        played = True
-                        sound.play()
-                    dt = clock.tick(30)
-                    timer += dt
-                    for event in pygame.event.get():
-                        if event.type == pygame.QUIT:
-                            running = False
-                            endgame = False
-                        if event.type == pygame.MOUSEBUTTONDOWN and timer > 2000:
-                            endgame = False
-                    fadeout = 5000
-                    fadeSurface.set_alpha(min(int((timer)*(255/fadeout)),255))
-                    self.screen.blit(fadeSurface,fadeSurface.get_rect())
-                    if timer > fadeout/3:
-                        if not self.win:
-                            GOtext = self.font.render("Game Over",True,(255,255,255))
-                        else:
-                            GOtext = self.font.render("Fox get! You win!",True,(255,255,255))
-                            foximgRect = self.foximg.get_rect()
-                            foximgRect = foximgRect.move(self.width//2-foximgRect.width//2,self.height//3+10)
-                            self.screen.blit(self.foximg,foximgRect)
-                        clickText = self.font.render("Click to return to start screen",True,(255,255,255))
-
-                        goTextRect = GOtext.get_rect()
-                        clickTextRect = clickText.get_rect()
-                        clickTextRect = clickTextRect.move(self.width/2.0-clickTextRect.width/2.0,
-                                                           self.height/4.0-clickTextRect.height/2.0+\
-                                                           goTextRect.height)
-                        goTextRect = goTextRect.move(self.width/2.0-goTextRect.width/2.0,
-                                                     self.height/4.0-goTextRect.height/2.0-\
-                                                     clickTextRect.height)
-                        scoreText = self.font.render("Score: "+str(self.score),True,(255,255,255))
-                        scoreTextRect = scoreText.get_rect()
-                        scoreTextRect = scoreTextRect.move(self.width-scoreTextRect.width,0)
-
-                        self.screen.blit(scoreText,scoreTextRect)
-                        self.screen.blit(GOtext,goTextRect)
-                        self.screen.blit(clickText,clickTextRect)
-                    pygame.display.flip()
-                sound.stop()
-                self.state = 2
-            
-            elif self.state == 2:
-                pygame.mixer.music.stop()
-                self.screen.fill((0,0,0))
-                menu = True
-                while menu:
-                    for event in pygame.event.get():
-                        if event.type == pygame.QUIT:
-                            running = False
-                            menu = False
-                        if event.type == pygame.MOUSEBUTTONDOWN:
-                            menu = False
-                    playText = self.font.render("Click to play",True,(255,255,255))
-                    playTextRect = playText.get_rect()
-                    playTextRect = playTextRect.move(self.width//2-playTextRect.width//2,
-                                                     self.height//3)
-                    
-                    sysfont = pygame.font.SysFont("monospace",24)
-                    attribText = sysfont.render("John Brooks | http://www.fastquake.com/",True,(255,255,255))
-                    attribTextRect = attribText.get_rect()
-                    attribTextRect = attribTextRect.move(self.width//2-attribTextRect.width//2,
-                                                         self.height-attribTextRect.height)
-                    
-                    self.screen.blit(attribText,attribTextRect)
-                    self.screen.blit(playText,playTextRect)
-                    
-                    pygame.display.flip()
-                pygame.mixer.music.rewind()
-                pygame.mixer.music.play(-1) #Play looping music
-                self.gameInit() #Initialize game world
+                        self.running = False
+                    elif event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                        self.showProfile = not self.showProfile
+                        profiler.enabled = self.showProfile or profiler.trace
+                        self.repaint = True #Repaint where the overlay was
+                    else:
+                        self.state.handle(event)
+            with profiler.phase("wait"):
+                fps = self.state.fps
+                if fps is None:
+                    fps = self.fps
+                frameTime = min(self.clock.tick(fps),self.maxFrameTime)
+            with profiler.phase("update"):
+                self.state.update(frameTime)
+            with profiler.phase("draw"):
+                self.state.render()
+            profiler.endFrame()
+        self.state.leave()
+        if self.renderer is not None:
+            self.renderer.stop()
+        if self.replay is not None:
+            seconds = timeit.default_timer()-start
+            sys.stdout.write("Replayed %d steps in %.2f s, %d frames at %.2f ms on average\n" %
+                             (self.replay.steps,seconds,frames,seconds*1000/frames))
+        if self.levels is not None:
+            self.levels.shutdown()
+        assets.shutdown()
+        if self.profileTrace is not None:
+            self.profiler.writeTrace(self.profileTrace)
 
     def draw(self):
-        self.screen.fill(self.bg_colour)
-        for x,column in enumerate(self.level.data):
-            for y,tile in enumerate(self.level.data[x]):
-                tilesize = Map.tilesize
-                tilex = x*tilesize - self.cameraX
-                tiley = y*tilesize - self.cameraY
-                tilerect = pygame.Rect(tilex,tiley,tilesize,tilesize)
-                if tile == Map.FLOOR or tile == Map.TURRET:
-                    self.screen.blit(self.floorTile,tilerect)
-                if tile == Map.WALL:
-                    self.screen.blit(self.wallTile,tilerect)
-        playerScreenRect = self.player.rect.move(-self.cameraX,-self.cameraY)
-        self.screen.blit(self.player.sprite,playerScreenRect)
-        for bullet in self.bullets:
-            bulletScreenRect = bullet.rect.move(-self.cameraX,-self.cameraY)
-            self.screen.blit(bullet.sprite,bulletScreenRect)
-        for turret in self.level.turrets:
-            turretScreenRect = turret.rect.move(-self.cameraX,-self.cameraY)
-            self.screen.blit(self.turretTile,turretScreenRect)
-        foxScreenRect = self.fox.rect.move(-self.cameraX,-self.cameraY)
-        self.screen.blit(self.fox.sprite,foxScreenRect)
-
-        livesText = self.font.render("Lives: "+str(self.lives),True,(255,255,255))
-        livesTextRect = livesText.get_rect()
-        healthText = self.font.render("Health: "+str(self.health),True,(255,255,255))
-        healthTextRect = healthText.get_rect()
-        healthTextRect = healthTextRect.move(0,livesTextRect.height)
+        """Draw the game as it is now, or hand it to the render thread"""
+        if self.renderer is None:
+            rects = self.drawFrame(self.snapshot(self.frame))
+            with self.profiler.phase("present"):
+                self.present(rects)
+        else:
+            self.renderer.submit(self.snapshot(self.renderer.getBack()))
 
-        scoreText = self.font.render("Score: "+str(self.score),True,(255,255,255))
-        scoreTextRect = scoreText.get_rect()
-        scoreTextRect = scoreTextRect.move(self.width-scoreTextRect.width,0)
+    def snapshot(self,frame):
+        """Fill in frame with what the game shows now, returns it"""
+        cameraX = int(self.cameraX)
+        cameraY = int(self.cameraY)
+        frame.cameraX = cameraX
+        frame.cameraY = cameraY
+        screenRect = pygame.Rect(0,0,self.width,self.height)
+        frame.terrain = self.terrain.getBlits(cameraX,cameraY,screenRect)
+        turretTile = assets.image("turret.png")
+        frame.statics = [(turretTile,turret.rect.move(-cameraX,-cameraY)) for turret in
+                         self.sim.level.turretHash.query(screenRect.move(cameraX,cameraY))]
+        foxScreenRect = self.sim.fox.rect.move(-cameraX,-cameraY)
+        if foxScreenRect.colliderect(screenRect):
+            frame.statics.append((self.sim.fox.sprite,foxScreenRect))
+        frame.sprites = self.entitySprites(cameraX,cameraY)
+        frame.hud = (self.sim.lives,self.sim.health,self.sim.score,self.signalWidth())
+        frame.profile = self.profileSnapshot() if self.showProfile else None
+        frame.repaint = self.repaint
+        self.repaint = False
+        return frame
 
-        self.screen.blit(scoreText,scoreTextRect)
-        self.screen.blit(livesText,livesTextRect)
-        self.screen.blit(healthText,healthTextRect)
+    def profileSnapshot(self):
+        """Copy of the profiler numbers drawProfile shows"""
+        return (list(self.profiler.frameTimes),list(self.profiler.averages.items()))
 
-        signalText = self.font.render("Signal",True,(255,255,255))
-        signalTextRect = signalText.get_rect()
-        signalTextRect = signalTextRect.move(self.width//2-\
-                                             signalTextRect.width//2,0)
+    def drawFrame(self,frame,profiler=None):
+        """Draw frame on the screen surface. Returns the rects of it to
+        present, None for all of it; presenting is left to the caller since
+        this may run on the render thread."""
+        profiler = profiler or self.profiler
+        if self.dirtyRects:
+            return self.drawDirty(frame,profiler)
+        with profiler.phase("terrain"):
+            self.screen.fill(self.bg_colour)
+            self.screen.blits(frame.terrain,False)
+        with profiler.phase("entities"):
+            self.screen.blits(frame.sprites,False)
+            self.screen.blits(frame.statics,False)
+        with profiler.phase("hud"):
+            self.hud.update(*frame.hud)
+            self.hud.draw(self.screen)
+        if frame.profile is not None:
+            self.drawProfile(frame.profile)
+        return None
 
-        bar = self.signalBar()
-        barRect = bar.get_rect()
-        barRect = barRect.move(self.width//2-barRect.width//2,
-                               signalTextRect.height+5)
+    def drawProfile(self,profile):
+        """The profiler overlay: average time of each phase and a graph of
+        the last frame times, with a line at one simulation step. profile
+        is from profileSnapshot."""
+        frameTimes,averages = profile
+        rect = self.profileRect
+        now = timeit.default_timer()
+        if self.profileText is None or now-self.profileTextTime > 0.25:
+            self.profileTextTime = now
+            frame = sum(frameTimes)/len(frameTimes) if frameTimes else 0
+            lines = ["frame      %6.2f ms %4d fps" % (frame*1000,1/frame if frame else 0)]
+            for name,milliseconds in averages:
+                lines.append("%-10s %6.2f ms" % (name,milliseconds))
+            lineHeight = self.profileFont.get_linesize()
+            self.profileText = pygame.Surface((rect.width,rect.height-50)).convert()
+            for i,line in enumerate(lines):
+                self.profileText.blit(self.profileFont.render(line,True,(255,255,255)),
+                                      (4,i*lineHeight))
+        self.screen.blit(self.profileText,rect)
+        graph = pygame.Rect(rect.left,rect.bottom-50,rect.width,50)
+        self.screen.fill((0,0,0),graph)
+        scale = graph.height/(2*self.tickLength) #Two steps fill the graph
+        for i,seconds in enumerate(frameTimes):
+            height = min(int(seconds*1000*scale),graph.height)
+            x = graph.left+2*i
+            pygame.draw.line(self.screen,(0,255,0),(x,graph.bottom-1),
+                             (x,graph.bottom-height))
+        stepY = graph.bottom-int(self.tickLength*scale)
+        pygame.draw.line(self.screen,(255,0,0),(graph.left,stepY),(graph.right-1,stepY))
 
-        self.screen.blit(signalText,signalTextRect)
-        self.screen.blit(bar,barRect)
+    def entitySprites(self,cameraX,cameraY):
+        """(sprite,screen rect) pairs of the moving entities"""
+        playerX,playerY = self.sim.player.lerp(self.alpha)
+        playerRect = self.sim.player.rect.copy()
+        playerRect.topleft = (int(playerX)-cameraX,int(playerY)-cameraY)
+        sprites = [(self.sim.player.sprite,playerRect)]
+        sprites.extend(self.sim.bullets.getSprites(cameraX,cameraY,self.width,
+                                               self.height,self.alpha))
+        return sprites
 
-        pygame.display.flip()
-Application().run()
-pygame.quit()
-sys.exit()
+    def restore(self,rect,frame):
+        """Repaint the background (terrain, turrets and fox) under a screen rect"""
+        rect = rect.clip(self.screen.get_rect())
+        if rect.width == 0 or rect.height == 0:
+            return
+        oldClip = self.screen.get_clip()
+        self.screen.set_clip(rect)
+        self.screen.fill(self.bg_colour,rect)
+        self.screen.blits(frame.terrain,False)
+        self.screen.blits([(sprite,spriteRect) for sprite,spriteRect in frame.statics
+                           if spriteRect.colliderect(rect)],False)
+        self.screen.set_clip(oldClip)
+
+    def drawDirty(self,frame,profiler):
+        """Dirty rectangle variant of drawFrame. The previous frame is kept
+        on screen; when the camera moves it is scrolled and only the exposed
+        strips are painted, then the entities of the last frame are erased
+        and drawn again. The HUD is only drawn again when it changed or
+        something moved under it. Turrets and the fox count as background
+        here, so moving entities are drawn over them, and where one was last
+        frame but isn't any more (a turret was destroyed) is repainted."""
+        cameraX = frame.cameraX
+        cameraY = frame.cameraY
+        screenRect = self.screen.get_rect()
+        if self.lastCamera is None or frame.repaint:
+            dx = dy = self.width #Nothing usable on screen, force a full redraw
+        else:
+            dx = self.lastCamera[0]-cameraX
+            dy = self.lastCamera[1]-cameraY
+        self.lastCamera = (cameraX,cameraY)
+        lastRects = self.lastRects
+
+        with profiler.phase("hud"):
+            hudChanged = self.hud.update(*frame.hud)
+        sprites = frame.sprites
+        rects = [rect for sprite,rect in sprites]
+        self.lastRects = rects
+        lastStatics = self.lastStatics
+        statics = set(tuple(rect) for sprite,rect in frame.statics)
+        self.lastStatics = statics
+
+        if abs(dx) >= self.width or abs(dy) >= self.height:
+            with profiler.phase("terrain"):
+                self.restore(screenRect,frame)
+            with profiler.phase("entities"):
+                self.screen.blits(sprites,False)
+            with profiler.phase("hud"):
+                self.hud.draw(self.screen)
+            if frame.profile is not None:
+                self.drawProfile(frame.profile)
+            return None
+
+        #Where last frame's entities are now, they have to be painted over
+        dirty = [rect.move(dx,dy) for rect in lastRects]
+        for x,y,width,height in lastStatics:
+            if (x+dx,y+dy,width,height) not in statics:
+                dirty.append(pygame.Rect(x+dx,y+dy,width,height))
+        #The HUD goes on top, so it is drawn again if anything touched it
+        redrawHud = hudChanged or dx or dy or\
+                    self.hud.rect.collidelist(dirty) != -1 or\
+                    self.hud.rect.collidelist(rects) != -1
+        if dx or dy:
+            self.screen.scroll(dx,dy)
+            if dx > 0:
+                dirty.append(pygame.Rect(0,0,dx,self.height))
+            elif dx < 0:
+                dirty.append(pygame.Rect(self.width+dx,0,-dx,self.height))
+            if dy > 0:
+                dirty.append(pygame.Rect(0,0,self.width,dy))
+            elif dy < 0:
+                dirty.append(pygame.Rect(0,self.height+dy,self.width,-dy))
+            dirty.append(self.hud.rect.move(dx,dy))
+            if frame.profile is not None:
+                dirty.append(self.profileRect.move(dx,dy))
+        if redrawHud:
+            dirty.append(self.hud.rect)
+        with profiler.phase("terrain"):
+            for rect in dirty:
+                self.restore(rect,frame)
+        with profiler.phase("entities"):
+            self.screen.blits(sprites,False)
+        if redrawHud:
+            with profiler.phase("hud"):
+                self.hud.draw(self.screen)
+        if frame.profile is not None:
+            self.drawProfile(frame.profile) #Opaque, covers whatever was under it
+            dirty.append(self.profileRect)
+        if dx or dy:
+            return None #Everything moved
+        return dirty+rects
+
+def parseSize(text):
+    """Parse a WIDTHxHEIGHT command line argument"""
+    try:
+        width,height = text.lower().split("x")
+        return int(width),int(height)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected WIDTHxHEIGHT, got "+repr(text))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FoxHunt")
+    parser.add_argument("--dirty-rects",action="store_true",
+                        help="only repaint and update the parts of the screen that changed")
+    parser.add_argument("--resolution",type=parseSize,default=(800,600),
+                        help="internal render resolution, e.g. 640x480")
+    parser.add_argument("--window",type=parseSize,default=None,
+                        help="window size, defaults to the render resolution")
+    parser.add_argument("--scale",choices=("stretch","smooth","integer"),
+                        default="stretch",help="how the render is scaled to the window")
+    parser.add_argument("--fps",type=int,default=60,
+                        help="frame rate limit, 0 for none. The game itself always runs at 30 steps a second")
+    parser.add_argument("--visibility-tables",type=int,default=0,metavar="BYTES",
+                        help="memory budget for precomputed turret visibility, 0 to trace every shot. --replay uses the recorded one")
+    parser.add_argument("--seed",type=int,default=None,
+                        help="generate every level from this seed")
+    parser.add_argument("--map-size",type=parseSize,default=(80,80),
+                        help="level size in tiles, e.g. 200x200")
+    parser.add_argument("--rooms",type=int,default=None,
+                        help="number of rooms (per region with --world), 6 to 12 at random by default")
+    parser.add_argument("--world",type=parseSize,default=None,metavar="WxH",
+                        help="play one huge level of WxH regions streamed in as you explore")
+    parser.add_argument("--region-size",type=int,default=64,metavar="TILES",
+                        help="size of the regions of --world, a multiple of 16")
+    parser.add_argument("--turret-radius",type=int,default=20,metavar="TILES",
+                        help="turrets further than this from the player are paused")
+    parser.add_argument("--level-processes",action="store_true",
+                        help="generate upcoming levels in a worker process instead of a thread")
+    parser.add_argument("--debug-map",action="store_true",
+                        help="print every generated level and its generation times")
+    parser.add_argument("--profile-trace",metavar="FILE",
+                        help="profile every frame and write a Chrome trace (chrome://tracing) to FILE on exit")
+    parser.add_argument("--voices",type=int,default=16,
+                        help="most sounds played at once")
+    parser.add_argument("--audio-buffer",type=int,default=512,metavar="SAMPLES",
+                        help="mixer buffer size, smaller plays sounds sooner but may crackle")
+    parser.add_argument("--record",metavar="FILE",
+                        help="record the first game's input to FILE")
+    parser.add_argument("--replay",metavar="FILE",
+                        help="play back a game recorded with --record and quit")
+    parser.add_argument("--fast-replay",action="store_true",
+                        help="replay a step every frame instead of in real time, with --fps 0 as fast as frames are drawn")
+    parser.add_argument("--render-thread",action="store_true",
+                        help="draw each frame on another thread while the next one is simulated")
+    parser.add_argument("--asset-log",action="store_true",
+                        help="print how long each asset took to load and the time to the first frame")
+    parser.add_argument("--rotation-steps",type=int,default=64,metavar="N",
+                        help="number of pre-rotated bullet sprites")
+    args = parser.parse_args()
+    try:
+        levelgen.checkRooms(args.rooms)
+    except ValueError as error:
+        parser.error("--rooms: %s" % error)
+    try:
+        levelgen.checkMapSize(*args.map_size)
+    except ValueError as error:
+        parser.error("--map-size: %s" % error)
+    try:
+        StreamingMap.checkRegionSize(args.region_size)
+    except ValueError as error:
+        parser.error("--region-size: %s" % error)
+    if args.world is not None:
+        try:
+            StreamingMap.checkWorldRegions(args.world)
+        except ValueError as error:
+            parser.error("--world: %s" % error)
+    if args.rotation_steps < 1:
+        parser.error("--rotation-steps: must be at least 1, not %d" % args.rotation_steps)
+    Bullets.rotationSteps = args.rotation_steps
+    assets.verbose = args.asset_log
+    worldOptions = None
+    if args.world is not None:
+        worldOptions = dict(worldRegions=args.world,regionSize=args.region_size,
+                            seed=args.seed,numRooms=args.rooms)
+    Application(dirtyRects=args.dirty_rects,resolution=args.resolution,
+                windowSize=args.window,scaleMode=args.scale,
+                levelOptions=dict(xSize=args.map_size[0],ySize=args.map_size[1],
+                                  numRooms=args.rooms,seed=args.seed),
+                mapOptions=dict(visibilityBudget=args.visibility_tables,
+                                debug=args.debug_map,
+                                activityRadius=args.turret_radius),
+                levelProcesses=args.level_processes,
+                worldOptions=worldOptions,fps=args.fps,
+                profileTrace=args.profile_trace,voices=args.voices,
+                audioBuffer=args.audio_buffer,record=args.record,
+                replay=args.replay,fastReplay=args.fast_replay,
+                pipelined=args.render_thread).run()
+    pygame.quit()
+    sys.exit()
@@ -0,0 +1,285 @@
+"""Play FoxHunt without a window or sound, as fast as the CPU allows, with
+a bot doing the playing. Good for soak testing levels, checking turret
+balance and measuring simulation speed. Many games can be spread over a
+pool of processes and summed up:
+
+    python headless.py --games 1000 --workers 8
+
+A game recorded with game.py --record (or here with --record) is played
+back with --replay, the Simulation only, as fast as it goes.
+"""
+from __future__ import division
+import os
+#Before pygame is imported, nothing here needs a real display or mixer
+os.environ.setdefault("SDL_VIDEODRIVER","dummy")
+os.environ.setdefault("SDL_AUDIODRIVER","dummy")
+import argparse
+import collections
+import functools
+import json
+import sys
+import timeit
+from concurrent.futures import ProcessPoolExecutor
+import pygame
+import levelgen
+from game import Map,Simulation,Turret,describeLevel,buildLevel
+from replay import Recorder,Replay,inputBits,setDirection
+from vector import Vector
+
+class Bot:
+    """Walks the shortest way over the floor to the fox, one tile center
+    at a time, and every shootInterval steps shoots at the nearest turret
+    it can see"""
+    shootInterval = 10
+
+    def __init__(self,sim):
+        self.sim = sim
+        self.path = [] #Tiles still to walk through, the next one first
+        self.previous = None #Last tile reached
+        self.direction = Vector()
+        self.lastPosition = None
+        self.stuck = 0 #Steps without moving
+
+    def playerCenter(self):
+        player = self.sim.player
+        return (player.x+player.rect.width//2,player.y+player.rect.height//2)
+
+    def findPath(self,start,goal):
+        """Tiles from start (excluded) to goal over floor, breadth first.
+        Turrets can stand in the way, those get shot until they're gone."""
+        level = self.sim.level
+        data = level.data
+        cameFrom = {start:None}
+        queue = collections.deque([start])
+        while queue:
+            tile = queue.popleft()
+            if tile == goal:
+                break
+            x,y = tile
+            for nextTile in ((x+1,y),(x-1,y),(x,y+1),(x,y-1)):
+                if nextTile in cameFrom:
+                    continue
+                nextX,nextY = nextTile
+                if 0 <= nextX < level.xSize and 0 <= nextY < level.ySize and\
+                   data[nextX,nextY] in (Map.FLOOR,Map.TURRET):
+                    cameFrom[nextTile] = tile
+                    queue.append(nextTile)
+        if goal not in cameFrom:
+            return []
+        path = []
+        tile = goal
+        while tile != start:
+            path.append(tile)
+            tile = cameFrom[tile]
+        path.reverse()
+        return path
+
+    def move(self):
+        """Direction to move this step"""
+        tilesize = Map.tilesize
+        centerX,centerY = self.playerCenter()
+        tile = (int(centerX//tilesize),int(centerY//tilesize))
+        if (centerX,centerY) == self.lastPosition:
+            self.stuck += 1
+        else:
+            self.stuck = 0
+        self.lastPosition = (centerX,centerY)
+        #Respawned, pushed off the path or walking into something
+        if not self.path or self.stuck > 5 or\
+           (tile != self.path[0] and tile != self.previous):
+            fox = self.sim.fox
+            goal = (int((fox.x+fox.rect.width//2)//tilesize),
+                    int((fox.y+fox.rect.height//2)//tilesize))
+            self.path = self.findPath(tile,goal)
+            self.previous = tile
+            self.stuck = 0
+
+        direction = self.direction.set(0,0)
+        if self.path:
+            nextX,nextY = self.path[0]
+            dx = nextX*tilesize+tilesize//2-centerX
+            dy = nextY*tilesize+tilesize//2-centerY
+            close = Simulation.playerSpeed/2
+            if abs(dx) <= close and abs(dy) <= close:
+                self.previous = self.path.pop(0)
+            else:
+                if abs(dx) > close:
+                    direction.x = 1 if dx > 0 else -1
+                if abs(dy) > close:
+                    direction.y = 1 if dy > 0 else -1
+        return direction
+
+    def target(self):
+        """Center of the nearest turret in sight, or None"""
+        if self.sim.ticks % Bot.shootInterval:
+            return None
+        level = self.sim.level
+        centerX,centerY = self.playerCenter()
+        reach = Turret.rangeTiles*Map.tilesize
+        area = pygame.Rect(centerX-reach,centerY-reach,2*reach,2*reach)
+        best = None
+        for turret in level.turretHash.query(area):
+            turretX,turretY = turret.rect.center
+            distance = (turretX-centerX)**2+(turretY-centerY)**2
+            if (best is None or distance < best[0]) and\
+               level.lineOfSight(centerX,centerY,turretX,turretY):
+                best = (distance,turretX,turretY)
+        if best is None:
+            return None
+        return best[1:]
+
+def playGame(seed,xSize=80,ySize=80,numRooms=None,maxTicks=30*60*10,
+             visibilityBudget=0,record=None):
+    """Play one game on the level generated from seed, returns its stats.
+    Games still going after maxTicks steps are stopped. With record (a
+    file name) the bot's input is recorded there."""
+    start = timeit.default_timer()
+    level = Map(levelData=levelgen.generate(xSize,ySize,numRooms,seed),
+                visibilityBudget=visibilityBudget)
+    sim = Simulation(level,seed=seed)
+    bot = Bot(sim)
+    recorder = None
+    if record is not None:
+        header = describeLevel(level,numRooms)
+        header["seed"] = seed
+        recorder = Recorder(record,header)
+    turrets = len(level.turrets)
+    events = collections.Counter()
+    playerShots = 0
+    while not sim.over and sim.ticks < maxTicks:
+        target = bot.target()
+        if target is not None:
+            if recorder is not None:
+                recorder.shoot(*target)
+            sim.shoot(*target)
+            playerShots += 1
+        direction = bot.move()
+        if recorder is not None:
+            recorder.step(inputBits(direction))
+        sim.tick(direction)
+        events.update(name for name,x,y in sim.events)
+        del sim.events[:]
+    if recorder is not None:
+        recorder.close()
+    return gameStats(sim,timeit.default_timer()-start,events,playerShots,turrets)
+
+def replayGame(path):
+    """Play back a recorded game, returns its stats like playGame. The
+    level is built as it was recorded, visibility tables included."""
+    start = timeit.default_timer()
+    replay = Replay(path)
+    level = buildLevel(replay.header)
+    sim = Simulation(level,seed=replay.header["seed"])
+    direction = Vector()
+    turrets = len(level.turrets)
+    events = collections.Counter()
+    playerShots = 0
+    step = replay.next()
+    while step is not None and not sim.over:
+        bits,shots = step
+        for x,y in shots:
+            sim.shoot(x,y)
+        playerShots += len(shots)
+        sim.tick(setDirection(direction,bits))
+        events.update(name for name,x,y in sim.events)
+        del sim.events[:]
+        step = replay.next()
+    return gameStats(sim,timeit.default_timer()-start,events,playerShots,turrets)
+
+def gameStats(sim,seconds,events,playerShots,turrets):
+    """Stats of a finished game, events counting the sounds it made and
+    turrets being how many there were at the start"""
+    return {"seed":sim.seed,
+            "win":sim.win,
+            "timeout":not sim.over,
+            "ticks":sim.ticks,
+            "seconds":seconds,
+            "ticksPerSecond":sim.ticks/seconds,
+            "score":sim.score,
+            "deaths":events["die"],
+            "playerShots":playerShots,
+            "turretShots":events["bullet"]-playerShots,
+            "turretsDestroyed":turrets-len(sim.level.turrets)}
+
+def runBatch(seeds,workers=None,**options):
+    """Play a game for each seed on a pool of processes, returns their
+    stats in seed order"""
+    seeds = list(seeds)
+    play = functools.partial(playGame,**options)
+    if workers == 1:
+        return [play(seed) for seed in seeds]
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers) as executor:
+        chunk = max(1,len(seeds)//(workers*8))
+        return list(executor.map(play,seeds,chunksize=chunk))
+
+def summarize(results,elapsed):
+    """Totals and averages over games"""
+    games = len(results)
+    def mean(key):
+        return sum(result[key] for result in results)/games
+    ticks = sum(result["ticks"] for result in results)
+    return collections.OrderedDict([
+        ("games",games),
+        ("wins",sum(result["win"] for result in results)),
+        ("winRate",mean("win")),
+        ("timeouts",sum(result["timeout"] for result in results)),
+        ("meanTicks",mean("ticks")),
+        ("meanDeaths",mean("deaths")),
+        ("meanScore",mean("score")),
+        ("playerShots",sum(result["playerShots"] for result in results)),
+        ("turretShots",sum(result["turretShots"] for result in results)),
+        ("meanTurretsDestroyed",mean("turretsDestroyed")),
+        ("meanTicksPerSecond",mean("ticksPerSecond")), #Per process
+        ("totalTicksPerSecond",ticks/elapsed), #All processes
+        ("seconds",elapsed)])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Play FoxHunt headless with a bot")
+    parser.add_argument("--games",type=int,default=1,help="number of games")
+    parser.add_argument("--seed",type=int,default=0,
+                        help="seed of the first game, the others count up from it")
+    parser.add_argument("--workers",type=int,default=None,
+                        help="processes to play on, defaults to one per CPU")
+    parser.add_argument("--map-size",type=int,nargs=2,default=(80,80),metavar=("W","H"),
+                        help="level size in tiles")
+    parser.add_argument("--rooms",type=int,default=None,
+                        help="number of rooms, 6 to 12 at random by default")
+    parser.add_argument("--max-ticks",type=int,default=30*60*10,
+                        help="give up on a game after this many steps (30 a second)")
+    parser.add_argument("--visibility-tables",type=int,default=0,metavar="BYTES",
+                        help="memory budget for precomputed turret visibility, --replay uses the recorded one")
+    parser.add_argument("--record",metavar="FILE",
+                        help="record the game to FILE, only one game is played")
+    parser.add_argument("--replay",metavar="FILE",
+                        help="play back a recorded game instead")
+    parser.add_argument("--json",metavar="FILE",
+                        help="write every game's stats and the summary to FILE")
+    args = parser.parse_args()
+    try:
+        levelgen.checkRooms(args.rooms)
+    except ValueError as error:
+        parser.error("--rooms: %s" % error)
+    try:
+        levelgen.checkMapSize(*args.map_size)
+    except ValueError as error:
+        parser.error("--map-size: %s" % error)
+
+    start = timeit.default_timer()
+    options = dict(xSize=args.map_size[0],ySize=args.map_size[1],numRooms=args.rooms,
+                   maxTicks=args.max_ticks,visibilityBudget=args.visibility_tables)
+    if args.replay:
+        results = [replayGame(args.replay)]
+    elif args.record:
+        results = [playGame(args.seed,record=args.record,**options)]
+    else:
+        results = runBatch(range(args.seed,args.seed+args.games),args.workers,**options)
+    summary = summarize(results,timeit.default_timer()-start)
+    for key,value in summary.items():
+        if isinstance(value,float):
+            sys.stdout.write("%s: %.3f\n" % (key,value))
+        else:
+            sys.stdout.write("%s: %s\n" % (key,value))
+    if args.json:
+        with open(args.json,"w") as stream:
+            json.dump({"summary":summary,"games":results},stream,indent=1)
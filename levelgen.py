@@ -0,0 +1,334 @@
+"""Level generation. Everything here is plain data (numpy, bytearrays,
+tuples) with no pygame objects, so levels can be generated on a worker
+thread or in another process and turned into a live Map afterwards."""
+from __future__ import division
+import collections
+import random
+import sys
+import timeit
+import numpy
+from concurrent.futures import ThreadPoolExecutor,ProcessPoolExecutor
+
+#Tile types
+EMPTY = 0
+FLOOR = 1
+WALL = 2
+TURRET = 3
+
+TILESIZE = 48 #tile size in pixels
+
+class Room:
+    minSize = 4
+    maxSize = 10
+    def __init__(self,x,y,xSize,ySize):
+        self.x = x
+        self.y = y
+        self.xSize = xSize
+        self.ySize = ySize
+
+    @staticmethod
+    def placeIn(region,rng):
+        """A randomly sized room somewhere in an (x,y,width,height) region,
+        keeping a tile free on each side for the walls"""
+        x,y,width,height = region
+        xSize = rng.randint(Room.minSize,min(Room.maxSize,width-2))
+        ySize = rng.randint(Room.minSize,min(Room.maxSize,height-2))
+        return Room(rng.randint(x+1,x+width-1-xSize),
+                    rng.randint(y+1,y+height-1-ySize),xSize,ySize)
+
+class LevelData:
+    """Everything needed to build a Map: the tiles, the rooms, where the
+    player and the fox start and the turrets to create"""
+    def __init__(self,seed,xSize,ySize):
+        self.seed = seed
+        self.xSize = xSize
+        self.ySize = ySize
+        #One byte per tile, tile x,y is at x*ySize+y
+        self.tiles = bytearray(xSize*ySize)
+        self.rooms = []
+        self.spawnX = self.spawnY = 0
+        self.foxX = self.foxY = 0
+        self.turrets = [] #(x,y,shootTimerEnd,health), position in pixels
+        #Seconds each generation stage took
+        self.timings = collections.OrderedDict()
+
+    def getArray(self):
+        """The tiles as a numpy array indexed [x,y], sharing their memory"""
+        return numpy.frombuffer(self.tiles,dtype=numpy.uint8)\
+                    .reshape(self.xSize,self.ySize)
+
+    def timeStage(self,stage,start):
+        """Record how long a generation stage took, returns the time now"""
+        now = timeit.default_timer()
+        self.timings[stage] = now-start
+        return now
+
+    def dump(self,stream=sys.stdout):
+        dump(self.getArray(),stream)
+
+def dump(data,stream=sys.stdout):
+    """Write a tile array indexed [x,y] as ASCII art"""
+    symbols = {FLOOR:'A',EMPTY:'-',WALL:'2',TURRET:'3'}
+    for y in range(data.shape[1]):
+        stream.write(''.join(symbols[tile] for tile in data[:,y].tolist()))
+        stream.write('\n')
+
+def partition(xSize,ySize,count,rng):
+    """Binary space partition of a map into about count or more disjoint
+    (x,y,width,height) regions that each fit a room, fewer if the map is
+    too small. They come out in tree order, so regions next to each other
+    in the list are close on the map."""
+    minSize = Room.minSize+2
+    targetArea = xSize*ySize/count
+    regions = []
+    stack = [(0,0,xSize,ySize)]
+    while stack:
+        x,y,width,height = stack.pop()
+        splitX = width >= 2*minSize
+        splitY = height >= 2*minSize
+        if width*height <= targetArea or not (splitX or splitY):
+            if width >= minSize and height >= minSize:
+                regions.append((x,y,width,height))
+            continue
+        if splitX and (not splitY or width > height or
+                       (width == height and rng.random() < 0.5)):
+            split = rng.randint(minSize,width-minSize)
+            first = (x,y,split,height)
+            second = (x+split,y,width-split,height)
+        else:
+            split = rng.randint(minSize,height-minSize)
+            first = (x,y,width,split)
+            second = (x,y+split,width,height-split)
+        stack.append(second)
+        stack.append(first)
+    return regions
+
+def checkRooms(numRooms):
+    """Raise ValueError unless numRooms (None for random) is a usable room
+    count: the fox needs a room other than the spawn room"""
+    if numRooms is not None and numRooms < 2:
+        raise ValueError("a level needs at least two rooms, not %d" % numRooms)
+
+def checkMapSize(xSize,ySize):
+    """Raise ValueError unless an xSize x ySize map fits two rooms: partition
+    has to be able to split it once"""
+    minSize = Room.minSize+2
+    if max(xSize,ySize) < 2*minSize or min(xSize,ySize) < minSize:
+        raise ValueError("a %dx%d map is too small for two rooms, it needs to be at least %dx%d" %
+                         (xSize,ySize,2*minSize,minSize))
+
+def layoutRooms(xSize,ySize,numRooms,rng):
+    """Non-overlapping rooms for an xSize x ySize map, in partition order"""
+    checkRooms(numRooms)
+    checkMapSize(xSize,ySize)
+    regions = partition(xSize,ySize,numRooms,rng)
+    if len(regions) > numRooms:
+        #Keep the tree order so rooms next in the list stay close
+        regions = [regions[i] for i in sorted(rng.sample(range(len(regions)),numRooms))]
+    return [Room.placeIn(region,rng) for region in regions]
+
+def roomCenter(room):
+    """Center of a room in pixels"""
+    return (room.x*TILESIZE + (room.xSize*TILESIZE)//2,
+            room.y*TILESIZE + (room.ySize*TILESIZE)//2)
+
+def carveHallway(data,room1,room2):
+    """Floor an L shaped hallway from the side of room1 to room2's center"""
+    xCenter1 = room1.x+room1.xSize//2
+    xCenter2 = room2.x+room2.xSize//2
+    yCenter1 = room1.y+room1.ySize//2
+    yCenter2 = room2.y+room2.ySize//2
+
+    if abs(xCenter1-xCenter2) > room1.xSize:
+        if (xCenter1-xCenter2) < 0: #second room is to the right
+            hallwayStart = (room1.x+room1.xSize,yCenter1)
+        else:
+            hallwayStart = (room1.x-1,yCenter1)
+    else:
+        if (yCenter1-yCenter2) < 0: #second room is higher
+            hallwayStart = (xCenter1,room1.y-1)
+        else:
+            hallwayStart = (xCenter1,room1.y+room1.ySize)
+
+    startX,startY = hallwayStart
+    length = abs(startX-xCenter2)
+    if startX < xCenter2:
+        data[startX:startX+length,yCenter1] = FLOOR
+        endX = startX+length
+    else:
+        data[startX-length+1:startX+1,yCenter1] = FLOOR
+        endX = startX-length
+
+    length = abs(startY-yCenter2)
+    if startY < yCenter2:
+        data[endX,startY:startY+length] = FLOOR
+    else:
+        data[endX,startY-length+1:startY+1] = FLOOR
+
+def placeTurrets(level,rooms,skip,rng,offsetX=0,offsetY=0):
+    """Put a turret on about one tile in 15 of every room except skip.
+    offsetX,offsetY (pixels) are added to the turret positions."""
+    data = level.getArray()
+    tilesize = TILESIZE
+    for room in rooms:
+        if room == skip:
+            continue
+        for tile in range(room.xSize*room.ySize):
+            if rng.random() < 1/15:
+                tileX = room.x+tile%room.xSize
+                tileY = room.y+tile//room.xSize
+                data[tileX,tileY] = TURRET
+                #Timer, turret will fire when it reaches a certain random number
+                shootTimerEnd = rng.randint(900,1325)
+                health = rng.randint(2,3)*50
+                level.turrets.append((offsetX+tileX*tilesize,offsetY+tileY*tilesize,
+                                      shootTimerEnd,health))
+
+def addWalls(data):
+    """Wall every empty tile next to (or diagonal to) a floor or turret"""
+    xSize,ySize = data.shape
+    inner = data[1:-1,1:-1] != EMPTY
+    near = numpy.zeros((xSize,ySize),dtype=bool)
+    for dx in (0,1,2):
+        for dy in (0,1,2):
+            if dx != 1 or dy != 1:
+                near[dx:xSize-2+dx,dy:ySize-2+dy] |= inner
+    data[near & (data == EMPTY)] = WALL
+
+def generate(xSize=80,ySize=80,numRooms=None,seed=None):
+    """Generate a level, returns its LevelData. Everything random about it
+    comes from seed, so the same seed gives the same level."""
+    checkRooms(numRooms)
+    if seed is None:
+        seed = random.randrange(1<<32)
+    rng = random.Random(seed)
+    level = LevelData(seed,xSize,ySize)
+    data = level.getArray()
+    start = timeit.default_timer()
+
+    if numRooms is None:
+        numRooms = rng.randint(6,12)
+    rooms = level.rooms = layoutRooms(xSize,ySize,numRooms,rng)
+    numRooms = len(rooms)
+    start = level.timeStage("layout",start)
+
+    #Create rooms
+    for room in rooms:
+        data[room.x:room.x+room.xSize,room.y:room.y+room.ySize] = FLOOR
+
+    spawnRoom = rooms[rng.randint(0,numRooms-1)]
+    level.spawnX,level.spawnY = roomCenter(spawnRoom)
+
+    foxRoom = spawnRoom
+    while foxRoom == spawnRoom:
+        foxRoom = rooms[rng.randint(0,numRooms-1)]
+    level.foxX,level.foxY = roomCenter(foxRoom)
+
+    #Create hallways between rooms
+    for i in range(numRooms-1):
+        carveHallway(data,rooms[i],rooms[i+1])
+    start = level.timeStage("rooms and hallways",start)
+
+    #Yet another loop through the rooms. This time we're
+    #adding turrets
+    placeTurrets(level,rooms,spawnRoom,rng)
+    start = level.timeStage("turrets",start)
+
+    #Finally add the walls
+    addWalls(data)
+    level.timeStage("walls",start)
+    return level
+
+def generateRegion(seed,regionX,regionY,regionSize=64,worldRegions=(32,32),
+                   numRooms=None,spawn=False):
+    """Generate one square region of a world made of worldRegions regions,
+    see StreamingMap. The region only depends on the world seed and its
+    position. A corridor runs from its nearest room to the middle of each
+    side that has a neighbour, where the neighbour's corridor meets it.
+    Positions in the LevelData are in world pixels, spawnX,spawnY is the
+    center of its first room and foxX,foxY that of its last room. The
+    first room gets no turrets if spawn is set."""
+    checkRooms(numRooms)
+    rng = random.Random("%d:%d:%d" % (seed,regionX,regionY))
+    level = LevelData(seed,regionSize,regionSize)
+    data = level.getArray()
+    offsetX = regionX*regionSize*TILESIZE
+    offsetY = regionY*regionSize*TILESIZE
+    start = timeit.default_timer()
+
+    if numRooms is None:
+        numRooms = rng.randint(4,8)
+    rooms = level.rooms = layoutRooms(regionSize,regionSize,numRooms,rng)
+    for room in rooms:
+        data[room.x:room.x+room.xSize,room.y:room.y+room.ySize] = FLOOR
+    for i in range(len(rooms)-1):
+        carveHallway(data,rooms[i],rooms[i+1])
+
+    #Hallways can end on the border, the neighbour wouldn't wall them off
+    for border in (data[0],data[-1],data[:,0],data[:,-1]):
+        border[border == FLOOR] = EMPTY
+
+    middle = regionSize//2
+    for dx,dy in ((-1,0),(1,0),(0,-1),(0,1)):
+        if not (0 <= regionX+dx < worldRegions[0] and 0 <= regionY+dy < worldRegions[1]):
+            continue
+        doorX = {-1:0,0:middle,1:regionSize-1}[dx]
+        doorY = {-1:0,0:middle,1:regionSize-1}[dy]
+        room = min(rooms,key=lambda room: abs(room.x+room.xSize//2-doorX)+
+                                          abs(room.y+room.ySize//2-doorY))
+        centerX = room.x+room.xSize//2
+        centerY = room.y+room.ySize//2
+        if dx: #Along the room's column to the door's row, then across
+            data[centerX,min(centerY,doorY):max(centerY,doorY)+1] = FLOOR
+            data[min(centerX,doorX):max(centerX,doorX)+1,doorY] = FLOOR
+        else:
+            data[min(centerX,doorX):max(centerX,doorX)+1,centerY] = FLOOR
+            data[doorX,min(centerY,doorY):max(centerY,doorY)+1] = FLOOR
+
+    level.spawnX,level.spawnY = roomCenter(rooms[0])
+    level.spawnX += offsetX
+    level.spawnY += offsetY
+    level.foxX,level.foxY = roomCenter(rooms[-1])
+    level.foxX += offsetX
+    level.foxY += offsetY
+    placeTurrets(level,rooms,rooms[0] if spawn else None,rng,offsetX,offsetY)
+    addWalls(data)
+    level.timeStage("region",start)
+    return level
+
+def _generate(options):
+    return generate(**options)
+
+class LevelProvider:
+    """Keeps the next few levels generating in the background, on a worker
+    thread or in a worker process, so starting a game doesn't wait for one.
+    options are the keyword arguments for generate."""
+    def __init__(self,options=None,size=2,processes=False):
+        self.options = dict(options or {})
+        self.size = size
+        if processes:
+            self.executor = ProcessPoolExecutor(1)
+        else:
+            self.executor = ThreadPoolExecutor(1)
+        self.pending = collections.deque()
+        self.fill()
+
+    def fill(self):
+        while len(self.pending) < self.size:
+            options = dict(self.options)
+            if options.get("seed") is None:
+                #Picked here, forked workers would all share a random state
+                options["seed"] = random.randrange(1<<32)
+            self.pending.append(self.executor.submit(_generate,options))
+
+    def get(self):
+        """LevelData of the next level, waits for it if it isn't done"""
+        future = self.pending.popleft()
+        self.fill()
+        return future.result()
+
+    def shutdown(self):
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,112 @@
+"""Recording a game's input and playing it back. Everything random in a
+game comes from seeds, so a recording only needs those and the input:
+
+    4 bytes   "FHR1"
+    4 bytes   length of the header, little endian
+    header    JSON: the seed of the Simulation and the level options,
+              see game.describeLevel
+    steps     zlib compressed, one per Simulation step: a byte of input
+              bits, and with SHOTS set a 2 byte count of the shots the
+              player fired before the step and then 4 byte x and y of each
+              one's target, in world pixels
+
+Played back, the same steps on the same level give the same game, so a
+recording is a repeatable load test (game.py --replay) or can be run
+through the Simulation alone, as fast as it goes (headless.py --replay).
+"""
+import json
+import struct
+import zlib
+
+MAGIC = b"FHR1"
+#Input bits of a step
+UP = 1
+DOWN = 2
+LEFT = 4
+RIGHT = 8
+SHOTS = 16 #Shots follow
+
+lengthFormat = struct.Struct("<I")
+countFormat = struct.Struct("<H")
+shotFormat = struct.Struct("<ii")
+
+def inputBits(direction):
+    """Input bits of a movement direction (a Vector)"""
+    bits = 0
+    if direction.y < 0:
+        bits |= UP
+    elif direction.y > 0:
+        bits |= DOWN
+    if direction.x < 0:
+        bits |= LEFT
+    elif direction.x > 0:
+        bits |= RIGHT
+    return bits
+
+def setDirection(direction,bits):
+    """Set direction (a Vector) to the movement in bits, returns it"""
+    direction.set(((bits & RIGHT) != 0)-((bits & LEFT) != 0),
+                  ((bits & DOWN) != 0)-((bits & UP) != 0))
+    return direction
+
+class Recorder:
+    """Writes a recording to path as the game is played. Call shoot for
+    each shot and then step with the input bits before each step."""
+    def __init__(self,path,header):
+        self.stream = open(path,"wb")
+        header = json.dumps(header,sort_keys=True).encode("utf-8")
+        self.stream.write(MAGIC+lengthFormat.pack(len(header))+header)
+        self.compressor = zlib.compressobj(9)
+        self.shots = []
+        self.steps = 0
+
+    def shoot(self,x,y):
+        self.shots.append((x,y))
+
+    def step(self,bits):
+        if self.shots:
+            data = bytearray((bits|SHOTS,))
+            data += countFormat.pack(len(self.shots))
+            for x,y in self.shots:
+                data += shotFormat.pack(x,y)
+            self.shots = []
+        else:
+            data = bytes((bits,))
+        self.stream.write(self.compressor.compress(bytes(data)))
+        self.steps += 1
+
+    def close(self):
+        self.stream.write(self.compressor.flush())
+        self.stream.close()
+
+class Replay:
+    """A recording read back from path, step by step with next"""
+    def __init__(self,path):
+        with open(path,"rb") as stream:
+            data = stream.read()
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s isn't a FoxHunt recording" % path)
+        start = len(MAGIC)+lengthFormat.size
+        length, = lengthFormat.unpack_from(data,len(MAGIC))
+        self.header = json.loads(data[start:start+length].decode("utf-8"))
+        self.data = zlib.decompress(data[start+length:])
+        self.position = 0
+        self.steps = 0
+
+    def next(self):
+        """(input bits,shots) of the next step, shots being a list of
+        (x,y) targets. None once the recording is over."""
+        data = self.data
+        if self.position >= len(data):
+            return None
+        bits = data[self.position]
+        self.position += 1
+        shots = []
+        if bits & SHOTS:
+            count, = countFormat.unpack_from(data,self.position)
+            self.position += countFormat.size
+            for i in range(count):
+                shots.append(shotFormat.unpack_from(data,self.position))
+                self.position += shotFormat.size
+        self.steps += 1
+        return bits & ~SHOTS,shots
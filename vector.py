@@ -0,0 +1,131 @@
+from __future__ import division
+import math
+import numpy
+
+class Vector(object):
+    """2D vector. The operators return new vectors; the in-place ones
+    (+=, -=, *=, set, normalizeInPlace) reuse this one, which is what the
+    per-frame code should use to avoid allocating."""
+    __slots__ = ("x","y")
+
+    def __init__(self,x=0,y=0):
+        self.x = x
+        self.y = y
+
+    def set(self,x,y):
+        self.x = x
+        self.y = y
+        return self
+
+    def getMagnitude(self):
+        return math.sqrt(self.x*self.x+self.y*self.y)
+
+    def getMagnitudeSquared(self):
+        """Cheaper than getMagnitude when only comparing lengths"""
+        return self.x*self.x+self.y*self.y
+
+    def normalize(self):
+        magnitude = math.sqrt(self.x*self.x+self.y*self.y)
+        if magnitude == 0:
+            return Vector()
+        return Vector(self.x/magnitude,self.y/magnitude)
+
+    def normalizeInPlace(self):
+        magnitude = math.sqrt(self.x*self.x+self.y*self.y)
+        if magnitude == 0:
+            self.x = self.y = 0
+        else:
+            self.x /= magnitude
+            self.y /= magnitude
+        return self
+
+    def __sub__(self,other):
+        try:
+            return Vector(self.x-other.x,self.y-other.y)
+        except AttributeError:
+            return NotImplemented
+
+    def __add__(self,other):
+        try:
+            return Vector(self.x+other.x,self.y+other.y)
+        except AttributeError:
+            return NotImplemented
+    def __radd__(self,other):
+        return self.__add__(other)
+
+    def __iadd__(self,other):
+        try:
+            self.x += other.x
+            self.y += other.y
+        except AttributeError:
+            return NotImplemented
+        return self
+
+    def __isub__(self,other):
+        try:
+            self.x -= other.x
+            self.y -= other.y
+        except AttributeError:
+            return NotImplemented
+        return self
+
+    def __mul__(self,other):
+        if isinstance(other,Vector):
+            return Vector(self.x*other.x,self.y*other.y)
+        else:
+            return Vector(self.x*other,self.y*other)
+    def __rmul__(self,other):
+        return self.__mul__(other)
+
+    def __imul__(self,other):
+        if isinstance(other,Vector):
+            self.x *= other.x
+            self.y *= other.y
+        else:
+            self.x *= other
+            self.y *= other
+        return self
+
+    def __str__(self):
+        return "("+str(self.x)+","+str(self.y)+")"
+
+    def __eq__(self,other):
+        try:
+            return self.x == other.x and self.y == other.y
+        except AttributeError:
+            return False
+    def __req__(self,other):
+        return self.__eq__(other)
+
+    def __ne__(self,other):
+        try:
+            return self.x != other.x or self.y != other.y
+        except AttributeError:
+            return False
+
+    __hash__ = None #Mutable
+
+    def dot(a,b):
+        if not isinstance(a,Vector) or not isinstance(b,Vector):
+            raise TypeError
+        return a.x*b.x + a.y*b.y
+
+#Batch versions working on numpy arrays of x and y components
+
+def magnitudes(xs,ys):
+    return numpy.hypot(xs,ys)
+
+def magnitudesSquared(xs,ys):
+    return xs*xs+ys*ys
+
+def normalizeMany(xs,ys):
+    """Unit vectors of the same directions, zero length ones stay zero"""
+    magnitude = numpy.hypot(xs,ys)
+    magnitude[magnitude == 0] = 1
+    return xs/magnitude,ys/magnitude
+
+def distancesSquared(xs,ys,x,y):
+    """Squared distance from each point to the point x,y"""
+    dx = xs-x
+    dy = ys-y
+    return dx*dx+dy*dy